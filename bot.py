@@ -2,45 +2,289 @@ import os
 import sys
 import logging
 import asyncio
-import uuid
 import time
 import fcntl
-from datetime import datetime
-from aiogram import Bot, Dispatcher, types, F
+import random
+import threading
+import queue
+import json
+import mmap
+import struct
+import heapq
+import gzip
+import shutil
+import argparse
+import tempfile
+import traceback
+import tracemalloc
+import hmac
+import hashlib
+import re
+import math
+import bisect
+from array import array
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from aiogram import Bot, Dispatcher, Router, BaseMiddleware, types, F
 from aiogram.filters import Command
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, InputMediaPhoto, InputMediaVideo
-from aiogram.utils.markdown import hbold, hcode
-from aiogram.exceptions import TelegramBadRequest, TelegramConflictError
-from contextlib import contextmanager
+from aiogram.filters.callback_data import CallbackData
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, InputMediaPhoto, InputMediaVideo, BufferedInputFile
+from aiogram.utils.markdown import hbold, hcode, hitalic
+from aiogram.exceptions import (
+    TelegramBadRequest, TelegramConflictError, TelegramRetryAfter,
+    TelegramNetworkError, TelegramServerError, TelegramEntityTooLarge,
+    TelegramForbiddenError
+)
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.base import BaseSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.methods import GetUpdates
+from aiogram.utils.token import TokenValidationError
+from contextlib import contextmanager, asynccontextmanager, nullcontext
+from functools import partial
+from enum import Enum
 
 # Определяем папку для данных (Railway volume)
 if os.path.exists('/app/data'):
-    DATA_DIR = '/app/data'
+    DEFAULT_DATA_DIR = '/app/data'
 else:
-    DATA_DIR = '.'
+    DEFAULT_DATA_DIR = '.'
+
+DEFAULT_ADMINS = [6038185249]  # Твой ID
+DEFAULT_CHANNEL_ID = -1003712283690  # ID канала
+
+FOOTER_TEXT = (
+    "────────────\n"
+    "📺 <a href='https://t.me/perehodniknaspletni'>Канал</a>\n"
+    "✉️ <a href='https://t.me/enkspletni_bot'>Анонка</a>"
+)
+
+# Режим сводки: заявки копятся DIGEST_WINDOW секунд и уходят админу одним сообщением
+DIGEST_WINDOW = 30
+DIGEST_MAX_ITEMS = 20  # заявок в одном сообщении сводки (4 кнопки на заявку, лимит Telegram - 100)
+
+# Заявку, взятую модератором, другие не могут взять столько секунд (если действие не завершилось)
+CLAIM_LEASE = 60
+
+# Отложенная публикация: посты из очереди выходят не чаще раза в SLOT_SPACING секунд
+SLOT_SPACING = 20 * 60
+QUIET_HOURS_START = 1  # с 1:00 до 8:00 в канал ничего не публикуется
+QUIET_HOURS_END = 8
+SCHEDULE_TZ = timezone(timedelta(hours=3))  # МСК
+SCHEDULE_MAX_ATTEMPTS = 5  # попыток публикации при временных ошибках, потом пост снимается
+
+# Режим /next: заявки не рассылаются, модераторы берут их по одной
+PULL_ALBUM_BOOST = 10 * 60    # сек. форы альбомам в очереди
+PULL_TRUSTED_BOOST = 30 * 60  # сек. форы доверенным авторам (TRUSTED)
+PULL_LEASE = 5 * 60           # сек. выданная через /next заявка закреплена за модератором
+PULL_COUNTER_INTERVAL = 30    # сек. - не чаще обновляется счётчик очереди у админов
+
+# Ответ цитатой: сколько последних сообщений карточек у админов помнится
+REPLY_INDEX_SIZE = 50_000
+
+# Повторная проверка недоступных пользователей
+REPROBE_INTERVAL = 24 * 60 * 60
+
+# Очередь приёма: обработчик только записывает заявку, рассылку админам делают воркеры
+INTAKE_QUEUE_SIZE = 1000  # сверх этого заявки сразу уходят в сводку
+INTAKE_HIGH_WATER = 100   # с такой глубины очереди воркеры шлют сводку вместо карточек
+INTAKE_WORKERS = 4
+
+# Поиск по заявкам и постам
+SEARCH_MAX_DOCS = 100_000  # при переполнении из индекса уходят самые старые посты
+SEARCH_MAX_TERMS = 64      # разных слов с одного поста
+SEARCH_PAGE_SIZE = 10
+SEARCH_SCAN_LIMIT = 1000   # постов с самым редким словом запроса, от новых к старым
 
-# Пути к файлам с данными
-USER_ID_FILE = os.path.join(DATA_DIR, "user_id_map.txt")
-POST_COUNTER_FILE = os.path.join(DATA_DIR, "post_number.txt")
-ADMIN_MODE_FILE = os.path.join(DATA_DIR, "admin_mode.txt")
-REPLY_COUNTER_FILE = os.path.join(DATA_DIR, "reply_counter.txt")
-LOCK_FILE = os.path.join(DATA_DIR, "bot.lock")  # Файл блокировки
+# Общая HTTP-сессия Bot API
+API_POOL_LIMIT = 50       # одновременных соединений к api.telegram.org
+API_KEEPALIVE = 30        # сек. держим простаивающее соединение
+API_TIMEOUT = 30          # сек. на один запрос
+API_MAX_RETRIES = 3       # повторов на один вызов
+API_BACKOFF_BASE = 0.5    # сек., удваивается с каждой попыткой
+API_BACKOFF_MAX = 10
+BREAKER_THRESHOLD = 5     # ошибок подряд, после которых метод отключается
+BREAKER_COOLDOWN = 60     # сек. метод не вызывается после срабатывания
+# Методы, которые можно безопасно повторить после таймаута: второй вызов ничего не дублирует
+IDEMPOTENT_METHOD_PREFIXES = ("Edit", "Delete", "AnswerCallbackQuery", "SendChatAction", "GetMe")
+
+# Фоновые задачи
+TASK_BACKOFF_BASE = 1      # сек. до первого перезапуска упавшей службы, дальше вдвое больше
+TASK_BACKOFF_MAX = 300
+TASK_BACKOFF_RESET = 60    # сек. работы без ошибок, после которых пауза снова минимальная
+TASK_DRAIN_TIMEOUT = 10    # сек. на завершение идущих задач при остановке
+
+# Сторож event loop
+LOOP_HEARTBEAT = 0.1       # сек. между пульсами
+LOOP_LAG_THRESHOLD = 0.25  # сек. без пульса, после которых снимается стек
+LOOP_LAG_SAMPLES = 3000    # последних замеров для процентилей (~5 минут)
+LOOP_STACK_DEPTH = 15      # кадров стека в логе
+
+# Запись трафика (TRACE_DIR) и проигрывание записи
+TRACE_SEGMENT_UPDATES = 10_000      # обновлений в одном сегменте .jsonl.gz
+TRACE_QUEUE_SIZE = 10_000           # сверх этого обновления не записываются, бот не ждёт диск
+TRACE_VERSION = 1
+TRACE_PSEUDONYM_BASE = 1 << 40      # псевдонимы не пересекаются с настоящими ID
+REPLAY_CONCURRENCY = 1000           # обновлений в обработке одновременно при проигрывании
+
+# ---------------- НАСТРОЙКИ И ЭКЗЕМПЛЯР БОТА ----------------
+class ConfigError(Exception):
+    """Не хватает настроек для запуска"""
+
+class AlreadyRunningError(Exception):
+    """Файл блокировки занят другим процессом"""
+    
+    def __init__(self, lock_path: str):
+        super().__init__(f"Бот уже запущен в другом экземпляре ({lock_path})")
+        self.lock_path = lock_path
+
+class BotConfig:
+    """Токен, админы, канал, папка с данными, подпись постов и доверенные авторы одного бота"""
+    
+    def __init__(self, token: str, admins=None, channel_id: int = None, data_dir: str = None, footer: str = "",
+                 trusted=None):
+        # Значения по умолчанию (канал и админы исходного бота) подставляет только from_env():
+        # бот из TENANTS_FILE без своих настроек не должен слать заявки и посты чужим
+        self.token = token
+        self.admins = list(admins) if admins else []
+        self.channel_id = channel_id
+        self.data_dir = data_dir
+        self.footer = footer
+        self.trusted = list(trusted) if trusted else []
+    
+    @classmethod
+    def from_env(cls):
+        """BOT_TOKEN обязателен; ADMINS и TRUSTED (через запятую), CHANNEL_ID и DATA_DIR - по желанию"""
+        token = os.environ.get("BOT_TOKEN")
+        if not token:
+            raise ConfigError("BOT_TOKEN не найден в переменных окружения!")
+        
+        try:
+            admins = [int(a) for a in os.environ.get("ADMINS", "").split(",") if a.strip()]
+            trusted = [int(t) for t in os.environ.get("TRUSTED", "").split(",") if t.strip()]
+            channel_id = int(os.environ["CHANNEL_ID"]) if os.environ.get("CHANNEL_ID") else None
+        except ValueError as e:
+            raise ConfigError(f"ADMINS, TRUSTED и CHANNEL_ID должны быть числами: {e}")
+        
+        return cls(token, admins or DEFAULT_ADMINS, channel_id or DEFAULT_CHANNEL_ID,
+                   os.environ.get("DATA_DIR") or DEFAULT_DATA_DIR, FOOTER_TEXT, trusted)
+
+def load_tenants(path: str) -> list:
+    """Файл с несколькими ботами - JSON-список:
+    [{"token": "...", "channel_id": -100..., "admins": [1, 2], "data_dir": "...", "footer": "...", "trusted": [3]}]
+    Вместо token можно указать token_env - имя переменной окружения с токеном.
+    channel_id, admins и footer обязательны: значений по умолчанию у ботов из файла нет.
+    Без data_dir данные бота лежат в папке bot<ID бота>"""
+    try:
+        with open(path, "r") as f:
+            entries = json.load(f)
+    except (OSError, ValueError) as e:
+        raise ConfigError(f"Не удалось прочитать {path}: {e}")
+    if not isinstance(entries, list) or not entries:
+        raise ConfigError(f"{path}: нужен непустой список ботов")
+    
+    configs = []
+    for number, entry in enumerate(entries, 1):
+        token = entry.get("token") or os.environ.get(entry.get("token_env", ""))
+        if not token:
+            raise ConfigError(f"{path}: у бота #{number} нет токена")
+        try:
+            admins = [int(a) for a in entry["admins"]]
+            channel_id = int(entry["channel_id"])
+            trusted = [int(t) for t in entry.get("trusted", [])]
+        except (KeyError, TypeError, ValueError):
+            raise ConfigError(f"{path}: у бота #{number} нужны числовые admins и channel_id (и trusted, если задан)")
+        if not admins:
+            raise ConfigError(f"{path}: у бота #{number} пустой список admins")
+        if not channel_id:
+            raise ConfigError(f"{path}: у бота #{number} не указан channel_id")
+        footer = entry.get("footer")
+        if not isinstance(footer, str) or not footer.strip():
+            raise ConfigError(f"{path}: у бота #{number} нет footer - подписи постов его канала")
+        data_dir = entry.get("data_dir") or os.path.join(DEFAULT_DATA_DIR, f"bot{token.split(':')[0]}")
+        configs.append(BotConfig(token, admins, channel_id, data_dir, footer, trusted))
+    return configs
 
-# Токен из переменных окружения
-TOKEN = os.environ.get("BOT_TOKEN")
-if not TOKEN:
-    print("❌ ОШИБКА: BOT_TOKEN не найден в переменных окружения!")
-    sys.exit(1)
+def load_configs() -> list:
+    """Боты из файла TENANTS_FILE, если он задан, иначе один бот из переменных окружения"""
+    tenants_file = os.environ.get("TENANTS_FILE")
+    if tenants_file:
+        return load_tenants(tenants_file)
+    return [BotConfig.from_env()]
 
-ADMINS = [6038185249]  # Твой ID
-CHANNEL_ID = -1003712283690  # ID канала
+class BotApp:
+    """Всё состояние одного бота. Создаётся через create_app() или create_apps(),
+    сам конструктор ничего не читает с диска"""
+    
+    def __init__(self, config: BotConfig):
+        self.config = config
+        self.admins = config.admins
+        self.channel_id = config.channel_id
+        self.data_dir = config.data_dir
+        self.trusted = set(config.trusted)
+        
+        # Пути к файлам с данными
+        self.user_id_file = os.path.join(self.data_dir, "user_id_map.txt")
+        self.post_counter_file = os.path.join(self.data_dir, "post_number.txt")
+        self.admin_mode_file = os.path.join(self.data_dir, "admin_mode.txt")
+        self.reply_counter_file = os.path.join(self.data_dir, "reply_counter.txt")
+        self.digest_mode_file = os.path.join(self.data_dir, "digest_mode.txt")
+        self.pull_mode_file = os.path.join(self.data_dir, "pull_mode.txt")
+        self.submission_counter_file = os.path.join(self.data_dir, "submission_counter.txt")
+        self.schedule_file = os.path.join(self.data_dir, "schedule.json")
+        self.reachability_file = os.path.join(self.data_dir, "user_reachability.bin")
+        self.lock_path = os.path.join(self.data_dir, "bot.lock")  # Файл блокировки
+        self.events_dir = os.path.join(self.data_dir, "events")  # Журнал модерации
+        self.archive_dir = os.path.join(self.data_dir, "archive")  # Опубликованные посты
+        
+        self.bot = None
+        self.dp = None
+        self.lock_file = None
+        self.event_log = None
+        self.post_archive = None
+        self.trace_recorder = None
+        
+        # Хранилище медиа групп и сообщений
+        self.media_groups = {}
+        self.user_messages = {}
+        self.digest_queue = []
+        self.digest_timer = None
+        self.digest_messages = {}  # (чат админа, ID сообщения) -> заявки в этой сводке
+        
+        self.user_id_map = {}
+        self.reachability = bytearray()  # байт на пользователя, индекс - внутренний ID
+        
+        self.submission_locks = {}   # номер заявки -> asyncio.Lock, пока идёт действие
+        self.submission_claims = {}  # номер заявки -> кто взял и до какого времени
+        
+        self.schedule_heap = []  # куча (время, номер заявки, публикация)
+        self.last_slot = 0
+        self.schedule_wakeup = asyncio.Event()
+        
+        self.intake = asyncio.Queue(maxsize=INTAKE_QUEUE_SIZE)  # (номер заявки, время постановки)
+        self.intake_waits = deque(maxlen=1000)  # сек. в очереди у последних заявок
+        self.intake_stats = {'queued': 0, 'shed': 0, 'overflow': 0}
+        
+        self.pull_heap = []  # куча (приоритет, номер заявки) для /next
+        self.pull_counters = {}  # админ -> ID сообщения со счётчиком очереди
+        self.pull_counter_timer = None
+        
+        self.search_index = SearchIndex()
+        self.search_queries = {}  # номер запроса -> текст, для кнопок листания
+        self.search_query_seq = 0
+        
+        self.tasks = TaskSupervisor()  # фоновые задачи этого бота
+        self.card_locks = {}  # чат админа -> asyncio.Lock, пока ему отправляется карточка
+        self.reply_index = {}  # (чат админа, ID сообщения карточки) -> (Telegram ID, внутренний ID, пост)
+        
+        self.startup_time = 0.0  # сек. на create_app()
 
 # ---------------- ЗАЩИТА ОТ МНОЖЕСТВЕННЫХ ЗАПУСКОВ ----------------
-def acquire_lock():
+def acquire_lock(lock_path: str):
     """Создает файл блокировки для предотвращения множественных запусков"""
     try:
         # Пытаемся открыть файл для блокировки
-        lock_file = open(LOCK_FILE, 'w')
+        lock_file = open(lock_path, 'w')
         # Пробуем получить эксклюзивную блокировку
         fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
         # Записываем PID процесса
@@ -51,44 +295,959 @@ def acquire_lock():
         # Не удалось получить блокировку - другой экземпляр уже запущен
         return None
 
-def release_lock(lock_file):
+def release_lock(lock_file, lock_path: str):
     """Освобождает файл блокировки"""
     if lock_file:
         try:
             fcntl.flock(lock_file, fcntl.LOCK_UN)
             lock_file.close()
-            os.unlink(LOCK_FILE)
+            os.unlink(lock_path)
         except:
             pass
 
-# ---------------- ИНИЦИАЛИЗАЦИЯ БОТА С ЗАЩИТОЙ ----------------
-lock_file = acquire_lock()
-if not lock_file:
-    print("❌ ОШИБКА: Бот уже запущен в другом экземпляре!")
-    print("   Если вы уверены, что это ошибка, удалите файл:", LOCK_FILE)
-    sys.exit(1)
+# ---------------- СЕССИЯ BOT API: ПОВТОРЫ И ПРЕДОХРАНИТЕЛЬ ----------------
+class CircuitOpenError(Exception):
+    """Метод временно не вызывается после серии ошибок подряд"""
 
-bot = Bot(token=TOKEN)
-dp = Dispatcher()
+class RetryMiddleware(BaseRequestMiddleware):
+    """Повторы с backoff, учёт retry_after и предохранитель для каждого метода Bot API"""
+    
+    def __init__(self):
+        self.stats = {}
+        self.failures = {}
+        self.open_until = {}
+    
+    def _stat(self, name: str) -> dict:
+        return self.stats.setdefault(name, {'calls': 0, 'retries': 0, 'failures': 0, 'rejected': 0})
+    
+    def _backoff(self, attempt: int) -> float:
+        delay = min(API_BACKOFF_MAX, API_BACKOFF_BASE * (2 ** attempt))
+        return random.uniform(delay / 2, delay)
+    
+    def is_open(self, name: str) -> bool:
+        return self.open_until.get(name, 0) > time.monotonic()
+    
+    async def __call__(self, make_request, bot, method):
+        # Long polling повторяет сам диспетчер
+        if isinstance(method, GetUpdates):
+            return await make_request(bot, method)
+        
+        name = type(method).__name__
+        stat = self._stat(name)
+        stat['calls'] += 1
+        
+        if self.is_open(name):
+            stat['rejected'] += 1
+            raise CircuitOpenError(f"{name} временно отключён после {BREAKER_THRESHOLD} ошибок подряд")
+        
+        attempt = 0
+        while True:
+            try:
+                result = await make_request(bot, method)
+                self.failures[name] = 0
+                return result
+            except TelegramRetryAfter as e:
+                if attempt >= API_MAX_RETRIES:
+                    self._record_failure(name)
+                    raise
+                delay = e.retry_after + random.uniform(0, 1)
+            except TelegramEntityTooLarge:
+                raise
+            except (TelegramNetworkError, TelegramServerError) as e:
+                if isinstance(e, TelegramNetworkError) and not self.safe_to_resend(name, e):
+                    self._record_failure(name)
+                    raise
+                if attempt >= API_MAX_RETRIES:
+                    self._record_failure(name)
+                    raise
+                delay = self._backoff(attempt)
+            
+            attempt += 1
+            stat['retries'] += 1
+            logging.warning(f"Повтор {name} #{attempt} через {delay:.1f} сек.")
+            await asyncio.sleep(delay)
+    
+    @staticmethod
+    def safe_to_resend(name: str, error: TelegramNetworkError) -> bool:
+        """Таймаут или обрыв могли случиться, когда Telegram уже выполнил запрос:
+        повторная отправка опубликовала бы пост дважды. Повторяются только методы,
+        которые можно выполнить повторно, и ошибки соединения - до них запрос не ушёл"""
+        return name.startswith(IDEMPOTENT_METHOD_PREFIXES) or error.message.startswith("ClientConnector")
+    
+    def _record_failure(self, name: str):
+        self._stat(name)['failures'] += 1
+        self.failures[name] = self.failures.get(name, 0) + 1
+        if self.failures[name] >= BREAKER_THRESHOLD:
+            self.open_until[name] = time.monotonic() + BREAKER_COOLDOWN
+            self.failures[name] = 0
+            logging.error(f"Предохранитель: {name} отключён на {BREAKER_COOLDOWN} сек.")
 
-FOOTER_TEXT = (
-    "────────────\n"
-    "📺 <a href='https://t.me/perehodniknaspletni'>Канал</a>\n"
-    "✉️ <a href='https://t.me/enkspletni_bot'>Анонка</a>"
-)
+class ReachabilityMiddleware(BaseRequestMiddleware):
+    """Отмечает пользователей, до которых не доходят сообщения, и тех, до кого снова доходят"""
+    
+    def __init__(self, apps: dict):
+        self.apps = apps  # ID бота -> BotApp: сессия общая для всех ботов процесса
+    
+    async def __call__(self, make_request, bot, method):
+        app = self.apps.get(bot.id)
+        chat_id = getattr(method, 'chat_id', None)
+        if app is None or not isinstance(chat_id, int) or chat_id not in app.user_id_map:
+            return await make_request(bot, method)
+        
+        try:
+            result = await make_request(bot, method)
+        except (TelegramForbiddenError, TelegramBadRequest) as e:
+            status = classify_send_error(e)
+            if status:
+                mark_reachability(app, chat_id, status)
+            raise
+        mark_reachability(app, chat_id, REACHABLE)
+        return result
+
+class TunedAiohttpSession(AiohttpSession):
+    """Сессия aiohttp с настроенным keep-alive"""
+    
+    def __init__(self, keepalive_timeout: float, **kwargs):
+        super().__init__(**kwargs)
+        self._connector_init["keepalive_timeout"] = keepalive_timeout
+
+api_retry = RetryMiddleware()
+
+def create_session(apps: dict, pollers: int = 1) -> AiohttpSession:
+    """Одна сессия и один пул соединений на все боты процесса.
+    Каждый бот держит соединение под long polling, поэтому пул расширяется на их число"""
+    session = TunedAiohttpSession(
+        keepalive_timeout=API_KEEPALIVE,
+        limit=API_POOL_LIMIT + pollers,
+        timeout=API_TIMEOUT
+    )
+    session.middleware(ReachabilityMiddleware(apps))
+    session.middleware(api_retry)
+    return session
+
+# ---------------- ФОНОВАЯ ЗАПИСЬ ФАЙЛОВ ----------------
+class StateWriter:
+    """Запись файлов состояния в отдельном потоке, чтобы не блокировать event loop.
+    
+    Повторные записи в один файл до сброса склеиваются (пишется последняя),
+    каждый файл заменяется атомарно: временный файл + os.replace.
+    Поток запускается при первой записи.
+    """
+    
+    def __init__(self):
+        self._pending = {}
+        self._busy = False
+        self._cond = threading.Condition()
+        self._thread = None
+    
+    def write(self, path: str, content):
+        """content - строка, байты или функция, возвращающая их (вызывается в потоке записи)"""
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="state-writer", daemon=True)
+                self._thread.start()
+            self._pending[path] = content
+            self._cond.notify_all()
+    
+    def flush(self, timeout: float = None) -> bool:
+        """Ждёт, пока всё поставленное в очередь окажется на диске"""
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._pending and not self._busy, timeout)
+    
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending)
+                batch = self._pending
+                self._pending = {}
+                self._busy = True
+            
+            for path, content in batch.items():
+                try:
+                    if callable(content):
+                        content = content()
+                    self._write_atomic(path, content)
+                except Exception as e:
+                    logging.error(f"Ошибка записи {path}: {e}")
+            
+            with self._cond:
+                self._busy = False
+                self._cond.notify_all()
+    
+    @staticmethod
+    def _write_atomic(path: str, content):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb" if isinstance(content, bytes) else "w") as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+# Общие для всех экземпляров: ключ - полный путь файла
+state_writer = StateWriter()
+state_cache = {}
+
+def read_state(path: str, default: str) -> str:
+    """Значение файла состояния: с диска читается один раз, дальше из памяти"""
+    if path not in state_cache:
+        value = default
+        if os.path.exists(path):
+            try:
+                with open(path, "r") as f:
+                    value = f.read().strip()
+            except Exception as e:
+                logging.error(f"Ошибка чтения {path}: {e}")
+        state_cache[path] = value
+    return state_cache[path]
+
+def write_state(path: str, value: str):
+    state_cache[path] = value
+    state_writer.write(path, value)
+
+def next_counter(path: str) -> int:
+    """Файл счётчика хранит следующий свободный номер"""
+    try:
+        num = int(read_state(path, "1"))
+    except ValueError:
+        num = 1
+    write_state(path, str(num + 1))
+    return num
+
+def peek_counter(path: str) -> int:
+    """Сколько номеров уже выдано"""
+    try:
+        return int(read_state(path, "1")) - 1
+    except ValueError:
+        return 0
+
+# ---------------- СТОРОЖ EVENT LOOP ----------------
+class LoopWatchdog:
+    """Задержка event loop и стеки блокирующих вызовов.
+    
+    Пульс - корутина, которая засыпает на LOOP_HEARTBEAT и замеряет, насколько
+    позже проснулась. Поток-сторож смотрит на время последнего пульса: если loop
+    молчит дольше LOOP_LAG_THRESHOLD, значит его держит синхронный вызов, и сторож
+    снимает стек главного потока прямо во время зависания.
+    """
+    
+    def __init__(self):
+        self.lags = deque(maxlen=LOOP_LAG_SAMPLES)  # задержки пульса, сек.
+        self.stalls = deque(maxlen=20)  # последние зависания со стеками
+        self.sites = {}  # место в bot.py -> сколько раз на нём ловили зависание
+        self.stall_count = 0
+        self.max_lag = 0.0
+        self._beat = 0.0
+        self._loop_thread = None
+        self._task = None
+        self._thread = None
+        self._stop = threading.Event()
+    
+    def start(self):
+        """Вызывается из работающего event loop"""
+        if self._task:
+            return
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.create_task(self._heartbeat())
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+    
+    def stop(self):
+        self._stop.set()
+        if self._task:
+            self._task.cancel()
+            self._task = None
+    
+    async def _heartbeat(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(LOOP_HEARTBEAT)
+            now = time.monotonic()
+            lag = max(now - started - LOOP_HEARTBEAT, 0.0)
+            
+            # Сторож видел зависание, пока оно шло; полную длительность знает только пульс
+            if self.stalls and self.stalls[-1]['beat'] == self._beat:
+                self.stalls[-1]['lag'] = lag
+            
+            self._beat = now
+            self.lags.append(lag)
+            self.max_lag = max(self.max_lag, lag)
+    
+    def _watch(self):
+        captured = None  # пульс, на котором стек уже снят
+        while not self._stop.wait(LOOP_HEARTBEAT):
+            beat = self._beat
+            stalled = time.monotonic() - beat - LOOP_HEARTBEAT
+            if stalled < LOOP_LAG_THRESHOLD or beat == captured:
+                continue
+            
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is None:
+                continue
+            captured = beat
+            stack = traceback.extract_stack(frame)[-LOOP_STACK_DEPTH:]
+            del frame
+            
+            site = blocking_site(stack)
+            self.sites[site] = self.sites.get(site, 0) + 1
+            self.stall_count += 1
+            self.stalls.append({'ts': time.time(), 'lag': stalled, 'beat': beat, 'site': site})
+            logging.warning(
+                f"Event loop занят {stalled:.2f} сек. ({site}), стек:\n" + "".join(traceback.format_list(stack))
+            )
+
+def blocking_site(stack) -> str:
+    """Самый глубокий кадр из bot.py: ниже него обычно стандартная библиотека"""
+    own = [entry for entry in stack if entry.filename == __file__]
+    entry = (own or stack)[-1]
+    return f"{entry.name}:{entry.lineno}"
+
+loop_watchdog = LoopWatchdog()
+
+# ---------------- ФОНОВЫЕ ЗАДАЧИ ----------------
+class DelayedCall:
+    """Отложенный вызов супервизора. Как у TimerHandle, cancel() после срабатывания
+    ничего не делает - уже начатая работа не обрывается"""
+    
+    def __init__(self, factory=None):
+        self.task = None
+        self.fired = False
+        self.factory = factory
+    
+    def cancel(self):
+        if self.task and not self.fired:
+            self.task.cancel()
+
+class TaskSupervisor:
+    """Фоновые задачи бота под именами, со ссылками на них до завершения.
+    
+    Как в asyncio.TaskGroup, задачи принадлежат супервизору и при остановке
+    дожидаются или отменяются. В отличие от TaskGroup, ошибка одной задачи не
+    отменяет остальные: служба перезапускается с растущей паузой, ошибка разовой
+    задачи попадает в лог и в отчёт /tasks.
+    """
+    
+    def __init__(self):
+        self.tasks = {}  # задача -> (имя, служба ли, отложенный вызов)
+        self.stats = {}  # имя -> счётчики для отчёта
+        self.timer = None  # HandlerTimer для времени каждого запуска (при проигрывании записи)
+    
+    def _stat(self, name: str) -> dict:
+        return self.stats.setdefault(name, {
+            'running': 0, 'started': 0, 'failures': 0, 'restarts': 0, 'runtime': 0.0, 'last_error': None,
+            'open': 0.0  # сумма времён старта идущих запусков
+        })
+    
+    @staticmethod
+    def runtime(stat: dict) -> float:
+        """Сек. работы всех запусков, включая идущие сейчас"""
+        return stat['runtime'] + stat['running'] * time.monotonic() - stat['open']
+    
+    def _track(self, name: str, coro, restart: bool, call: DelayedCall = None) -> asyncio.Task:
+        task = asyncio.create_task(coro, name=name)
+        self.tasks[task] = (name, restart, call)
+        task.add_done_callback(lambda done: self.tasks.pop(done, None))
+        return task
+    
+    def spawn(self, name: str, factory) -> asyncio.Task:
+        """Разовая задача; factory() создаёт корутину"""
+        return self._track(name, self._run(name, factory, False), False)
+    
+    def service(self, name: str, factory) -> asyncio.Task:
+        """Долгая задача: при ошибке factory() вызывается снова после паузы"""
+        return self._track(name, self._run(name, factory, True), True)
+    
+    def call_later(self, name: str, delay: float, factory) -> DelayedCall:
+        """Замена loop.call_later для корутин: задача отслеживается и её ошибки не теряются"""
+        call = DelayedCall(factory)
+        call.task = self._track(name, self._run(name, factory, False, delay, call), False, call)
+        return call
+    
+    async def _run(self, name: str, factory, restart: bool, delay: float = 0, call: DelayedCall = None):
+        if delay:
+            await asyncio.sleep(delay)
+        if call:
+            call.fired = True
+        
+        stat = self._stat(name)
+        backoff = TASK_BACKOFF_BASE
+        while True:
+            started = time.monotonic()
+            stat['running'] += 1
+            stat['started'] += 1
+            stat['open'] += started
+            try:
+                with nullcontext() if restart else self.timed(name):
+                    await factory()
+                return
+            except Exception as e:
+                stat['failures'] += 1
+                stat['last_error'] = (time.time(), f"{type(e).__name__}: {e}")
+                logging.error(f"Ошибка в задаче {name}: {e}", exc_info=e)
+            finally:
+                stat['running'] -= 1
+                stat['open'] -= started
+                stat['runtime'] += time.monotonic() - started
+            
+            if not restart:
+                return
+            # Долго проработавшая служба начинает с короткой паузы
+            if time.monotonic() - started > TASK_BACKOFF_RESET:
+                backoff = TASK_BACKOFF_BASE
+            logging.info(f"Задача {name} перезапустится через {backoff} сек.")
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, TASK_BACKOFF_MAX)
+            stat['restarts'] += 1
+    
+    def timed(self, name: str):
+        """Замер куска работы под именем name, если подключён timer"""
+        return self.timer.measure(name) if self.timer else nullcontext()
+    
+    async def run_pending(self, *names):
+        """Несработавшие отложенные вызовы с этими именами выполняются сразу; ждёт
+        и их, и уже идущие. shutdown() такие вызовы отменил бы"""
+        for task, (name, restart, call) in list(self.tasks.items()):
+            if name in names and call and not call.fired:
+                task.cancel()
+                self.spawn(name, call.factory)
+        await asyncio.gather(*(task for task, (name, _, _) in list(self.tasks.items()) if name in names),
+                             return_exceptions=True)
+    
+    async def shutdown(self, timeout: float = TASK_DRAIN_TIMEOUT):
+        """Службы и несработавшие отложенные вызовы отменяются сразу, уже идущим
+        разовым задачам даётся timeout секунд, потом отменяются и они"""
+        draining = []
+        for task, (name, restart, call) in list(self.tasks.items()):
+            if restart or (call and not call.fired):
+                task.cancel()
+            else:
+                draining.append(task)
+        
+        if draining:
+            _, pending = await asyncio.wait(draining, timeout=timeout)
+            for task in pending:
+                logging.warning(f"Задача {task.get_name()} не завершилась за {timeout} сек., отменяется")
+                task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+def format_duration(seconds: float) -> str:
+    if seconds < 60:
+        return f"{seconds:.1f} сек."
+    if seconds < 3600:
+        return f"{seconds / 60:.0f} мин."
+    return f"{seconds / 3600:.1f} ч."
 
-# ---------------- ХРАНИЛИЩЕ МЕДИА ГРУПП И СООБЩЕНИЙ ----------------
-media_groups = {}
-user_messages = {}
-channel_posts = {}
+# ---------------- ЖУРНАЛ МОДЕРАЦИИ ----------------
+EVENT_SEGMENT_SIZE = 16 * 1024 * 1024  # размер сегмента журнала, после него начинается новый
+INDEX_RECORD = struct.Struct("<IQ")  # номер сегмента (0 - нет записи), смещение в сегменте
+
+EVENT_TITLES = {
+    'submit': '📨 отправлен',
+    'schedule': '🕒 в очереди на публикацию',
+    'approve': '✅ опубликован',
+    'decline': '❌ отклонён',
+    'delete': '🗑 удалён из канала',
+    'unschedule': '⚠️ снят с расписания'
+}
+
+class MmapIndex:
+    """Индекс фиксированной ширины в mmap: номер -> запись record
+    (по умолчанию - сегмент и смещение в журнале)"""
+    
+    def __init__(self, path: str, initial_records: int = 4096, record: struct.Struct = INDEX_RECORD):
+        self._record = record
+        self._empty = record.unpack(bytes(record.size))
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        size = os.fstat(self._fd).st_size
+        if size < initial_records * record.size:
+            size = initial_records * record.size
+            os.ftruncate(self._fd, size)
+        self._mm = mmap.mmap(self._fd, size)
+    
+    def get(self, number: int):
+        pos = number * self._record.size
+        if number < 0 or pos + self._record.size > len(self._mm):
+            return self._empty
+        return self._record.unpack_from(self._mm, pos)
+    
+    def set(self, number: int, *fields):
+        pos = number * self._record.size
+        if pos + self._record.size > len(self._mm):
+            size = len(self._mm)
+            while pos + self._record.size > size:
+                size *= 2
+            self._mm.close()
+            os.ftruncate(self._fd, size)
+            self._mm = mmap.mmap(self._fd, size)
+        self._record.pack_into(self._mm, pos, *fields)
+    
+    def flush(self):
+        self._mm.flush()
+
+def list_segments(directory: str) -> list:
+    """Номера сегментов журнала по порядку"""
+    if not os.path.isdir(directory):
+        return []
+    return sorted(
+        int(name[7:-6]) for name in os.listdir(directory)
+        if name.startswith("events-") and name.endswith(".jsonl")
+    )
+
+def segment_path(directory: str, segment: int) -> str:
+    return os.path.join(directory, f"events-{segment:06d}.jsonl")
+
+class EventLog:
+    """Журнал модерации: сегменты JSONL только на дозапись и mmap-индексы.
+    
+    Каждое событие хранит ссылку 'prev' на предыдущее событие того же поста,
+    а отправка - ссылку 'prev_user' на предыдущую отправку того же пользователя.
+    Индексы указывают на последнее событие, поэтому история поста читается
+    за O(1), а k постов пользователя - за O(k) без просмотра журнала.
+    Запись идёт в отдельном потоке.
+    """
+    
+    def __init__(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.post_index = MmapIndex(os.path.join(directory, "post_index.bin"))
+        self.user_index = MmapIndex(os.path.join(directory, "user_index.bin"))
+        
+        segments = list_segments(directory)
+        self.segment = segments[-1] if segments else 1
+        self._file = open(self._segment_path(self.segment), "ab")
+        
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="event-log", daemon=True)
+        self._thread.start()
+    
+    def _segment_path(self, segment: int) -> str:
+        return segment_path(self.directory, segment)
+    
+    def record(self, kind: str, post_id: int, **fields):
+        """Ставит событие в очередь на запись"""
+        self._queue.put({'ts': int(time.time()), 'event': kind, 'post_id': post_id, **fields})
+    
+    def flush(self):
+        """Ждёт записи всех поставленных событий"""
+        self._queue.join()
+        with self._lock:
+            self.post_index.flush()
+            self.user_index.flush()
+    
+    def append_many(self, events: list):
+        """Массовая дозапись (импорт): мимо очереди и без сброса файла после каждого события"""
+        with self._lock:
+            for event in events:
+                event.pop('prev', None)
+                event.pop('prev_user', None)
+                self._append(event, flush=False)
+            self._file.flush()
+    
+    def _run(self):
+        while True:
+            event = self._queue.get()
+            try:
+                with self._lock:
+                    self._append(event)
+            except Exception as e:
+                logging.error(f"Ошибка записи в журнал: {e}")
+            finally:
+                self._queue.task_done()
+    
+    def _append(self, event: dict, flush: bool = True):
+        if self._file.tell() >= EVENT_SEGMENT_SIZE:
+            self._file.close()
+            self.segment += 1
+            self._file = open(self._segment_path(self.segment), "ab")
+        
+        post_id = event['post_id']
+        segment, offset = self.post_index.get(post_id)
+        if segment:
+            event['prev'] = [segment, offset]
+        
+        user_counter = event.get('user_id_counter') if event['event'] == 'submit' else None
+        if user_counter:
+            segment, offset = self.user_index.get(user_counter)
+            if segment:
+                event['prev_user'] = [segment, offset]
+        
+        offset = self._file.tell()
+        self._file.write(json.dumps(event, ensure_ascii=False).encode() + b"\n")
+        if flush:
+            self._file.flush()
+        
+        self.post_index.set(post_id, self.segment, offset)
+        if user_counter:
+            self.user_index.set(user_counter, self.segment, offset)
+    
+    def _read(self, segment: int, offset: int) -> dict:
+        with open(self._segment_path(segment), "rb") as f:
+            f.seek(offset)
+            return json.loads(f.readline())
+    
+    def post_events(self, post_id: int) -> list:
+        """История поста, от последнего события к первому"""
+        events = []
+        with self._lock:
+            segment, offset = self.post_index.get(post_id)
+            while segment:
+                event = self._read(segment, offset)
+                events.append(event)
+                segment, offset = event.get('prev', (0, 0))
+        return events
+    
+    def user_submissions(self, user_counter: int, limit: int = 20) -> list:
+        """Последние отправки пользователя с текущим статусом каждого поста"""
+        submissions = []
+        with self._lock:
+            segment, offset = self.user_index.get(user_counter)
+            while segment and len(submissions) < limit:
+                event = self._read(segment, offset)
+                status_segment, status_offset = self.post_index.get(event['post_id'])
+                if (status_segment, status_offset) != (segment, offset):
+                    event['status'] = self._read(status_segment, status_offset)['event']
+                else:
+                    event['status'] = 'submit'
+                submissions.append(event)
+                segment, offset = event.get('prev_user', (0, 0))
+        return submissions
+
+# ---------------- АРХИВ ОПУБЛИКОВАННЫХ ПОСТОВ ----------------
+ARCHIVE_MAX_IDS = 10  # сообщений в канале на пост: альбом - не больше 10
+# Заявка, пост, автор, время публикации, флаги, число ID, ID сообщений в канале; 64 байта
+ARCHIVE_RECORD = struct.Struct(f"<IIIIBB{ARCHIVE_MAX_IDS}I6x")
+ARCHIVE_FIELDS = 6 + ARCHIVE_MAX_IDS
+SLOT_RECORD = struct.Struct("<I")  # номер записи в архиве, 0 - нет
+ARCHIVE_DELETED = 1
+
+class PostArchive:
+    """Опубликованные посты на диске, чтобы кнопки удаления работали после перезапуска.
+    
+    posts.bin - записи фиксированной ширины по порядку публикации (запись 0 -
+    заголовок, в поле заявки - число записей), и два индекса номер -> запись:
+    по номеру заявки (его несёт кнопка удаления) и по номеру поста.
+    Всё в mmap: поиск - два чтения по смещению, в памяти только тронутые страницы.
+    """
+    
+    def __init__(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        self.records = MmapIndex(os.path.join(directory, "posts.bin"), 1024, ARCHIVE_RECORD)
+        self.by_submission = MmapIndex(os.path.join(directory, "submission_index.bin"), record=SLOT_RECORD)
+        self.by_post_id = MmapIndex(os.path.join(directory, "post_index.bin"), record=SLOT_RECORD)
+        self.count = self.records.get(0)[0]
+    
+    def __len__(self):
+        return self.count
+    
+    def add(self, submission_id: int, post_id: int, user_counter: int, message_ids: list,
+            published_at: int = None, deleted: bool = False):
+        if len(message_ids) > ARCHIVE_MAX_IDS:
+            logging.warning(f"Пост #{post_id}: в архив попадут только {ARCHIVE_MAX_IDS} из {len(message_ids)} сообщений")
+        ids = list(message_ids[:ARCHIVE_MAX_IDS])
+        slot = self.count + 1
+        self.records.set(
+            slot, submission_id, post_id, user_counter, published_at or int(time.time()),
+            ARCHIVE_DELETED if deleted else 0, len(ids), *ids, *[0] * (ARCHIVE_MAX_IDS - len(ids))
+        )
+        # Сначала запись и счётчик, потом индексы: после сбоя запись может остаться
+        # без индекса, но индекс не укажет на чужую запись
+        self.count = slot
+        self.records.set(0, slot, *[0] * (ARCHIVE_FIELDS - 1))
+        self.by_submission.set(submission_id, slot)
+        self.by_post_id.set(post_id, slot)
+    
+    def read(self, slot: int) -> dict:
+        fields = self.records.get(slot)
+        return {
+            'slot': slot,
+            'submission_id': fields[0],
+            'post_id': fields[1],
+            'user_counter': fields[2],
+            'published_at': fields[3],
+            'deleted': bool(fields[4] & ARCHIVE_DELETED),
+            'message_ids': list(fields[6:6 + fields[5]])
+        }
+    
+    def _lookup(self, index: "MmapIndex", key: str, number: int):
+        slot = index.get(number)[0]
+        if not slot or slot > self.count:
+            return None
+        post = self.read(slot)
+        return post if post[key] == number else None
+    
+    def get(self, submission_id: int):
+        """Пост по номеру заявки; None - если такой не публиковалась"""
+        return self._lookup(self.by_submission, 'submission_id', submission_id)
+    
+    def by_post(self, post_id: int):
+        return self._lookup(self.by_post_id, 'post_id', post_id)
+    
+    def mark_deleted(self, submission_id: int):
+        post = self.get(submission_id)
+        if post:
+            fields = list(self.records.get(post['slot']))
+            fields[4] |= ARCHIVE_DELETED
+            self.records.set(post['slot'], *fields)
+    
+    def __iter__(self):
+        for slot in range(1, self.count + 1):
+            yield self.read(slot)
+    
+    def flush(self):
+        self.records.flush()
+        self.by_submission.flush()
+        self.by_post_id.flush()
+
+# ---------------- ПОИСК ----------------
+SEARCH_WORD = re.compile(r"[0-9a-zа-я]+")
+
+# Окончания отбрасываются от самого длинного; основа остаётся не короче 3 букв
+RU_ENDINGS = sorted((
+    "иями", "ями", "ами", "иях", "ого", "его", "ому", "ему", "ыми", "ими", "ешь", "ете", "ите",
+    "ться", "ть", "ой", "ей", "ий", "ый", "ая", "яя", "ое", "ее", "ые", "ие", "ую", "юю",
+    "ом", "ем", "ах", "ях", "ов", "ев", "ам", "ям", "ет", "ют", "ут", "ит", "ат", "ят",
+    "ла", "ло", "ли", "ил", "ал", "ел", "а", "я", "о", "е", "ы", "и", "у", "ю", "ь", "й"
+), key=len, reverse=True)
+EN_ENDINGS = ("ing", "ed", "es", "s")
+
+# Служебные слова есть почти в каждом посте: по ним не ищем и не индексируем
+STOP_WORDS = frozenset((
+    "и", "в", "во", "не", "на", "с", "со", "что", "как", "а", "но", "да", "нет", "то", "же", "бы",
+    "по", "к", "ко", "у", "о", "об", "от", "до", "из", "за", "для", "при", "про", "без", "над", "под",
+    "я", "ты", "он", "она", "оно", "мы", "вы", "они", "его", "ее", "их", "мне", "меня", "тебя", "нас",
+    "вас", "это", "этот", "эта", "эти", "так", "там", "тут", "уже", "еще", "ли", "или", "если", "чтобы",
+    "вот", "ну", "все", "всё", "был", "была", "было", "были", "есть", "очень", "только", "когда", "кто",
+    "the", "a", "an", "and", "or", "of", "to", "in", "on", "is", "it", "for"
+))
+
+SEARCH_STATUS_TITLES = {
+    'pending': '⏳ на модерации',
+    'scheduled': '🕒 в очереди',
+    'published': '✅ опубликован'
+}
+
+def stem(word: str) -> str:
+    if len(word) <= 3 or word.isdigit():
+        return word
+    endings = RU_ENDINGS if "а" <= word[-1] <= "я" else EN_ENDINGS
+    for ending in endings:
+        if word.endswith(ending) and len(word) - len(ending) >= 3:
+            return word[:-len(ending)]
+    return word
+
+def search_terms(text: str) -> list:
+    """Слова текста: регистр сложен (ё = е), окончания отброшены, служебные слова
+    и одиночные буквы пропущены"""
+    text = text.casefold().replace("ё", "е")
+    return [sys.intern(stem(word)) for word in SEARCH_WORD.findall(text)
+            if word not in STOP_WORDS and (len(word) > 1 or word.isdigit())]
+
+SATURATION = (0.0, 1 / 2, 2 / 3, 3 / 4)  # вклад слова по числу повторов в посте: n / (n + 1)
+
+class SearchIndex:
+    """Инвертированный индекс по тексту постов: слово -> отсортированный массив записей
+    по 4 байта (номер поста << 2 | сколько раз слово встретилось, не больше 3).
+    
+    Пост хранит только статус, короткий фрагмент и свои слова (чтобы его можно
+    было убрать из индекса). Больше SEARCH_MAX_DOCS постов не держится -
+    самые старые вытесняются.
+    """
+    
+    def __init__(self, max_docs: int = SEARCH_MAX_DOCS):
+        self.max_docs = max_docs
+        self.postings = {}
+        self.docs = {}  # номер поста -> (статус, фрагмент, слова); порядок - порядок добавления
+    
+    def __len__(self):
+        return len(self.docs)
+    
+    @staticmethod
+    def _find(posting, post_id: int) -> int:
+        pos = bisect.bisect_left(posting, post_id << 2)
+        if pos < len(posting) and posting[pos] >> 2 == post_id:
+            return pos
+        return -1
+    
+    def add(self, post_id: int, text: str, status: str):
+        self.remove(post_id)
+        counts = {}
+        for term in search_terms(text):
+            counts[term] = counts.get(term, 0) + 1
+        terms = tuple(counts)[:SEARCH_MAX_TERMS]
+        for term in terms:
+            posting = self.postings.get(term)
+            if posting is None:
+                posting = self.postings[term] = array("I")
+            entry = post_id << 2 | min(counts[term], 3)
+            # Номера постов растут, так что обычно это дозапись в конец
+            if not posting or posting[-1] < entry:
+                posting.append(entry)
+            else:
+                bisect.insort(posting, entry)
+        
+        snippet = " ".join(text.split())
+        self.docs[post_id] = (status, snippet[:80] + ("…" if len(snippet) > 80 else ""), terms)
+        while len(self.docs) > self.max_docs:
+            self.remove(next(iter(self.docs)))
+    
+    def set_status(self, post_id: int, status: str):
+        doc = self.docs.get(post_id)
+        if doc:
+            self.docs[post_id] = (status,) + doc[1:]
+    
+    def remove(self, post_id: int):
+        doc = self.docs.pop(post_id, None)
+        if not doc:
+            return
+        for term in doc[2]:
+            posting = self.postings[term]
+            pos = self._find(posting, post_id)
+            if pos >= 0:
+                del posting[pos]
+            if not posting:
+                del self.postings[term]
+    
+    def search(self, query: str, limit: int):
+        """Посты, где есть все слова запроса: (сколько найдено, лучшие limit номеров, все ли
+        просмотрены). Вес слова - чем реже оно в индексе, тем больше; повторы в посте весят
+        всё меньше.
+        
+        Смотрятся только SEARCH_SCAN_LIMIT самых новых постов с самым редким словом запроса:
+        при равном весе и так выше более свежий пост, а перебор всех постов с частым словом
+        занимал десятки миллисекунд. Перебор кончается и раньше, если старый пост уже не
+        может обойти найденные.
+        """
+        terms = set(search_terms(query))
+        if not terms:
+            return 0, [], True
+        postings = sorted((self.postings.get(term, ()) for term in terms), key=len)
+        if not postings[0]:
+            return 0, [], True
+        
+        weights = [math.log(1 + len(self.docs) / len(posting)) for posting in postings]
+        ceiling = sum(weights) * SATURATION[3]  # вес поста, где каждое слово встретилось 3 раза
+        # [вес, записи, граница]: посты идут от новых к старым, так что следующий ищется левее границы
+        others = [[weight, posting, len(posting)] for weight, posting in zip(weights[1:], postings[1:])]
+        window = postings[0][-SEARCH_SCAN_LIMIT:]
+        complete = len(window) == len(postings[0])
+        
+        best = []  # куча (вес, номер) из limit лучших
+        found = 0
+        for entry in reversed(window):
+            post_id = entry >> 2
+            key = post_id << 2
+            score = weights[0] * SATURATION[entry & 3]
+            for other in others:
+                posting = other[1]
+                pos = bisect.bisect_left(posting, key, 0, other[2])
+                if pos == other[2] or posting[pos] >= key + 4:
+                    other[2] = pos
+                    break
+                other[2] = pos
+                score += other[0] * SATURATION[posting[pos] & 3]
+            else:
+                found += 1
+                if len(best) < limit:
+                    heapq.heappush(best, (score, post_id))
+                elif score > best[0][0]:
+                    heapq.heapreplace(best, (score, post_id))
+                elif best[0][0] >= ceiling:
+                    complete = False
+                    break
+        
+        return found, [post_id for _, post_id in sorted(best, reverse=True)], complete
+
+# ---------------- ДОСТУПНОСТЬ ПОЛЬЗОВАТЕЛЕЙ ----------------
+# Байт на пользователя, индекс - внутренний ID
+REACHABLE = 0
+BLOCKED = 1
+DEACTIVATED = 2
+CHAT_NOT_FOUND = 3
+
+UNREACHABLE_TITLES = {
+    BLOCKED: "заблокировал бота",
+    DEACTIVATED: "аккаунт удалён",
+    CHAT_NOT_FOUND: "чат не найден"
+}
+
+def load_reachability(app: BotApp):
+    if not os.path.exists(app.reachability_file):
+        return bytearray()
+    try:
+        with open(app.reachability_file, "rb") as f:
+            return bytearray(f.read())
+    except Exception as e:
+        logging.error(f"Ошибка загрузки доступности пользователей: {e}")
+        return bytearray()
+
+def classify_send_error(error: Exception) -> int:
+    """Ошибка, после которой писать пользователю бесполезно; REACHABLE - если это не такая ошибка"""
+    text = str(error).lower()
+    if isinstance(error, TelegramForbiddenError):
+        return DEACTIVATED if "deactivated" in text else BLOCKED
+    if isinstance(error, TelegramBadRequest) and "chat not found" in text:
+        return CHAT_NOT_FOUND
+    return REACHABLE
+
+def get_reachability(app: BotApp, telegram_id: int) -> int:
+    counter = app.user_id_map.get(telegram_id)
+    if counter is None or counter >= len(app.reachability):
+        return REACHABLE
+    return app.reachability[counter]
+
+def is_reachable(app: BotApp, telegram_id: int) -> bool:
+    return get_reachability(app, telegram_id) == REACHABLE
+
+def mark_reachability(app: BotApp, telegram_id: int, status: int):
+    counter = app.user_id_map.get(telegram_id)
+    if counter is None or get_reachability(app, telegram_id) == status:
+        return
+    if counter >= len(app.reachability):
+        app.reachability.extend(bytes(counter + 1 - len(app.reachability)))
+    app.reachability[counter] = status
+    state_writer.write(app.reachability_file, bytes(app.reachability))
+
+def count_unreachable(app: BotApp) -> int:
+    return len(app.reachability) - app.reachability.count(REACHABLE)
+
+async def reprobe_unreachable(app: BotApp):
+    """Раз в REPROBE_INTERVAL проверяет недоступных: вдруг разблокировали бота"""
+    while True:
+        await asyncio.sleep(REPROBE_INTERVAL)
+        
+        dead = [tid for tid in list(app.user_id_map) if not is_reachable(app, tid)]
+        revived = 0
+        for tid in dead:
+            try:
+                # Действие "печатает" - самый незаметный способ проверить чат
+                await app.bot.send_chat_action(tid, "typing")
+                revived += 1
+            except Exception:
+                pass
+            await asyncio.sleep(0.05)
+        
+        logging.info(f"Проверка доступности: {len(dead)} недоступных, снова доступны {revived}")
 
 # ---------------- Работа с ID пользователей ----------------
-def load_user_id_map():
-    if not os.path.exists(USER_ID_FILE):
+def load_user_id_map(app: BotApp):
+    if not os.path.exists(app.user_id_file):
+        return {}
+    try:
+        with open(app.user_id_file, "r") as f:
+            data = f.read()
+        # Обычный случай - все строки вида tid:uid, разбираем одним проходом
+        return {int(tid): int(uid) for tid, uid in (line.split(":") for line in data.split())}
+    except ValueError:
+        pass
+    except Exception as e:
+        logging.error(f"Ошибка загрузки user_id_map: {e}")
         return {}
+    
     mapping = {}
     try:
-        with open(USER_ID_FILE, "r") as f:
+        with open(app.user_id_file, "r") as f:
             for line in f:
                 line = line.strip()
                 if ':' in line:
@@ -100,21 +1259,19 @@ def load_user_id_map():
         logging.error(f"Ошибка загрузки user_id_map: {e}")
     return mapping
 
-def save_user_id_map(mapping):
-    try:
-        with open(USER_ID_FILE, "w") as f:
-            for tid, uid in mapping.items():
-                f.write(f"{tid}:{uid}\n")
-    except Exception as e:
-        logging.error(f"Ошибка сохранения user_id_map: {e}")
-
-user_id_map = load_user_id_map()
+def save_user_id_map(app: BotApp):
+    # Копия словаря снимается сразу, текст файла собирается уже в потоке записи
+    snapshot = dict(app.user_id_map)
+    state_writer.write(
+        app.user_id_file,
+        lambda: "".join(f"{tid}:{uid}\n" for tid, uid in snapshot.items())
+    )
 
-def get_next_user_counter():
+def get_next_user_counter(app: BotApp):
     """Получить следующий свободный ID пользователя"""
-    if not user_id_map:
+    if not app.user_id_map:
         return 1
-    used_ids = set(user_id_map.values())
+    used_ids = set(app.user_id_map.values())
     if not used_ids:
         return 1
     for i in range(1, max(used_ids) + 2):
@@ -122,129 +1279,154 @@ def get_next_user_counter():
             return i
     return max(used_ids) + 1
 
-def get_user_id_counter(telegram_id: int):
+def get_user_id_counter(app: BotApp, telegram_id: int):
     """Получить внутренний ID пользователя, создать если нет"""
-    check_duplicate_ids()
+    check_duplicate_ids(app)
     
-    if telegram_id in user_id_map:
-        return user_id_map[telegram_id]
+    if telegram_id in app.user_id_map:
+        return app.user_id_map[telegram_id]
     
-    next_id = get_next_user_counter()
-    user_id_map[telegram_id] = next_id
-    save_user_id_map(user_id_map)
+    next_id = get_next_user_counter(app)
+    app.user_id_map[telegram_id] = next_id
+    save_user_id_map(app)
     return next_id
 
-def get_telegram_id_by_counter(user_counter: int):
+def get_telegram_id_by_counter(app: BotApp, user_counter: int):
     """Получить Telegram ID по внутреннему ID"""
-    for tid, uid in user_id_map.items():
+    for tid, uid in app.user_id_map.items():
         if uid == user_counter:
             return tid
     return None
 
-def check_duplicate_ids():
+def check_duplicate_ids(app: BotApp):
     """Проверка и исправление дубликатов ID"""
-    global user_id_map
-    
-    value_to_keys = {}
-    for tid, uid in user_id_map.items():
-        if uid not in value_to_keys:
-            value_to_keys[uid] = []
-        value_to_keys[uid].append(tid)
-    
-    duplicates_found = False
-    for uid, tids in value_to_keys.items():
-        if len(tids) > 1:
-            duplicates_found = True
-            break
-    
-    if duplicates_found:
-        new_mapping = {}
-        next_id = 1
-        for tid in user_id_map.keys():
-            new_mapping[tid] = next_id
-            next_id += 1
-        user_id_map = new_mapping
-        save_user_id_map(user_id_map)
+    # Без дубликатов уникальных значений столько же, сколько ключей
+    if len(set(app.user_id_map.values())) == len(app.user_id_map):
+        return app.user_id_map
     
-    return user_id_map
-
-user_id_map = check_duplicate_ids()
+    new_mapping = {}
+    next_id = 1
+    for tid in app.user_id_map.keys():
+        new_mapping[tid] = next_id
+        next_id += 1
+    app.user_id_map = new_mapping
+    save_user_id_map(app)
+    return app.user_id_map
 
 # ---------------- СЧЁТЧИК ПОСТОВ ----------------
-def get_next_post_id():
-    try:
-        if not os.path.exists(POST_COUNTER_FILE):
-            with open(POST_COUNTER_FILE, "w") as f:
-                f.write("1")
-            return 1
-        with open(POST_COUNTER_FILE, "r") as f:
-            try:
-                num = int(f.read().strip())
-            except:
-                num = 1
-        with open(POST_COUNTER_FILE, "w") as f:
-            f.write(str(num + 1))
-        return num
-    except Exception as e:
-        logging.error(f"Ошибка счетчика постов: {e}")
-        return 1
+def get_next_post_id(app: BotApp):
+    return next_counter(app.post_counter_file)
+
+# ---------------- СЧЁТЧИК ЗАЯВОК ----------------
+def get_next_submission_id(app: BotApp):
+    """Номер заявки на модерацию. Хранится на диске, чтобы старые кнопки
+    после перезапуска не указали на чужую заявку"""
+    return next_counter(app.submission_counter_file)
 
 # ---------------- СЧЁТЧИК ОТВЕТОВ ----------------
-def get_next_reply_id():
-    try:
-        if not os.path.exists(REPLY_COUNTER_FILE):
-            with open(REPLY_COUNTER_FILE, "w") as f:
-                f.write("1")
-            return 1
-        with open(REPLY_COUNTER_FILE, "r") as f:
-            try:
-                num = int(f.read().strip())
-            except:
-                num = 1
-        with open(REPLY_COUNTER_FILE, "w") as f:
-            f.write(str(num + 1))
-        return num
-    except Exception as e:
-        logging.error(f"Ошибка счетчика ответов: {e}")
-        return 1
+def get_next_reply_id(app: BotApp):
+    return next_counter(app.reply_counter_file)
 
 # ---------------- РЕЖИМ ПРИНЯТИЯ ----------------
-def is_admin_accepting() -> bool:
-    if not os.path.exists(ADMIN_MODE_FILE):
-        return True
-    try:
-        with open(ADMIN_MODE_FILE, "r") as f:
-            return f.read().strip() == "on"
-    except:
-        return True
+def is_admin_accepting(app: BotApp) -> bool:
+    return read_state(app.admin_mode_file, "on") == "on"
 
-def set_admin_accepting(mode: bool):
-    try:
-        with open(ADMIN_MODE_FILE, "w") as f:
-            f.write("on" if mode else "off")
-    except Exception as e:
-        logging.error(f"Ошибка установки режима: {e}")
+def set_admin_accepting(app: BotApp, mode: bool):
+    write_state(app.admin_mode_file, "on" if mode else "off")
+
+# ---------------- РЕЖИМ СВОДКИ ----------------
+def is_digest_mode(app: BotApp) -> bool:
+    return read_state(app.digest_mode_file, "off") == "on"
+
+def set_digest_mode(app: BotApp, mode: bool):
+    write_state(app.digest_mode_file, "on" if mode else "off")
+
+# ---------------- РЕЖИМ ОЧЕРЕДИ /next ----------------
+def is_pull_mode(app: BotApp) -> bool:
+    return read_state(app.pull_mode_file, "off") == "on"
+
+def set_pull_mode(app: BotApp, mode: bool):
+    write_state(app.pull_mode_file, "on" if mode else "off")
 
 # ---------------- КЛАВИАТУРЫ ----------------
-def admin_keyboard(user_id_counter: int, post_id: int, unique_id: str = None):
+class Action(str, Enum):
+    approve = "a"
+    decline = "d"
+    delete = "x"
+    view = "v"
+    schedule = "s"
+    taken = "t"
+
+class ModerationCallback(CallbackData, prefix="m"):
+    """Кнопки модерации: m:<действие>:<номер заявки>, например m:a:1234"""
+    action: Action
+    submission_id: int
+
+def moderation_button(text: str, action: Action, submission_id: int):
+    return InlineKeyboardButton(
+        text=text,
+        callback_data=ModerationCallback(action=action, submission_id=submission_id).pack()
+    )
+
+def parse_moderation_callback(data: str):
+    try:
+        return ModerationCallback.unpack(data or '')
+    except (TypeError, ValueError):
+        return None
+
+def admin_keyboard(submission_id: int):
     """Клавиатура для админа с опциями публикации/отклонения"""
-    data = f"approve:{user_id_counter}:{post_id}:{unique_id}"
     return InlineKeyboardMarkup(inline_keyboard=[
         [
-            InlineKeyboardButton(text="✅ Опубликовать", callback_data=data),
-            InlineKeyboardButton(text="❌ Отклонить", callback_data=f"decline:{user_id_counter}:{post_id}:{unique_id}")
+            moderation_button("✅ Опубликовать", Action.approve, submission_id),
+            moderation_button("🕒 В очередь", Action.schedule, submission_id),
+            moderation_button("❌ Отклонить", Action.decline, submission_id)
         ]
     ])
 
-def published_keyboard(post_group_id: str):
-    """Клавиатура для удаления всего поста"""
+def digest_keyboard(record: dict):
+    """Клавиатура сводки: по строке на заявку (опубликовать / в очередь / отклонить / показать).
+    Заявки, взятые другим модератором, показываются одной кнопкой с его именем"""
+    rows = []
+    for submission_id, post_id in record['items']:
+        if submission_id in record['resolved']:
+            rows.append([moderation_button(record['resolved'][submission_id], Action.taken, submission_id)])
+            continue
+        rows.append([
+            moderation_button(f"✅ {post_id}", Action.approve, submission_id),
+            moderation_button(f"🕒 {post_id}", Action.schedule, submission_id),
+            moderation_button(f"❌ {post_id}", Action.decline, submission_id),
+            moderation_button(f"👁 {post_id}", Action.view, submission_id)
+        ])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+def taken_keyboard(submission_id: int, label: str):
+    """Карточка, которую уже обработал другой модератор"""
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [moderation_button(label, Action.taken, submission_id)]
+    ])
+
+class SearchCallback(CallbackData, prefix="q"):
+    """Листание результатов поиска: q:<номер запроса>:<страница>"""
+    query_id: int
+    page: int
+
+def search_keyboard(query_id: int, page: int, pages: int):
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton(text="◀️", callback_data=SearchCallback(query_id=query_id, page=page - 1).pack()))
+    if page + 1 < pages:
+        buttons.append(InlineKeyboardButton(text="▶️", callback_data=SearchCallback(query_id=query_id, page=page + 1).pack()))
+    return InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
+
+def published_keyboard(submission_id: int):
+    """Клавиатура для удаления всего поста"""
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🗑 Удалить пост из канала", callback_data=f"delete:{post_group_id}")]
+        [moderation_button("🗑 Удалить пост из канала", Action.delete, submission_id)]
     ])
 
 # ---------------- START ----------------
-@dp.message(Command("start"))
-async def start(message: types.Message):
+async def start(message: types.Message, app: BotApp):
     user_name = message.from_user.first_name or "друг"
     
     welcome_text = (
@@ -256,17 +1438,29 @@ async def start(message: types.Message):
     )
     
     await message.answer(welcome_text, parse_mode="HTML")
-    get_user_id_counter(message.from_user.id)
+    get_user_id_counter(app, message.from_user.id)
 
 # ---------------- HELP ----------------
-@dp.message(Command("help"))
-async def help_cmd(message: types.Message):
-    if message.from_user.id in ADMINS:
+async def help_cmd(message: types.Message, app: BotApp):
+    if message.from_user.id in app.admins:
         cmds = [
             "/stats 📊 - статистика",
-            "/broadcast 📢 - рассылка",
+            "/broadcast [all] 📢 - рассылка (all - и недоступным)",
             "/toggle_accept 🔄 - вкл/выкл прием от админа",
+            "/toggle_digest 📬 - вкл/выкл сводку заявок",
+            "/toggle_pull 📥 - вкл/выкл режим очереди /next",
+            "/next ⏭ - взять следующую заявку",
+            "/intake 📥 - очередь приёма заявок",
+            "/api_stats 📡 - повторы и ошибки Bot API",
+            "/lag ⏳ - задержка event loop",
+            "/tasks ⚙️ - фоновые задачи",
+            "/debug_mem [start|stop] 🧮 - отчёт о памяти",
+            "/schedule 🕒 - очередь публикаций",
+            "/post <номер> 📜 - история поста",
+            "/user_posts <ID> 🗂 - посты пользователя",
+            "/search <слова> 🔍 - поиск по заявкам и постам",
             "/reply <ID> <текст> 💬 - ответ пользователю (с фото/видео/кружком)",
+            "↩️ ответ на карточку заявки - ответ её автору",
             "/list_users 📋 - список пользователей",
             "/check_ids ✅ - проверить ID",
             "/myid 🆔 - узнать свой ID",
@@ -284,11 +1478,10 @@ async def help_cmd(message: types.Message):
         await message.answer(help_text, parse_mode="HTML")
 
 # ---------------- REPLY С ПОДДЕРЖКОЙ ВСЕХ ТИПОВ МЕДИА ----------------
-@dp.message(Command("reply"))
-async def admin_reply(message: types.Message):
+async def admin_reply(message: types.Message, app: BotApp):
     """Ответ пользователю с пересылкой любого типа медиа"""
     
-    if message.from_user.id not in ADMINS:
+    if message.from_user.id not in app.admins:
         return
     
     command_text = message.text or message.caption
@@ -304,7 +1497,7 @@ async def admin_reply(message: types.Message):
         
         user_counter = int(parts[1])
         reply_text = parts[2]
-        
+    
     except ValueError:
         await message.answer("❌ ID должен быть числом")
         return
@@ -312,10 +1505,10 @@ async def admin_reply(message: types.Message):
         await message.answer(f"❌ Ошибка: {e}")
         return
     
-    telegram_id = get_telegram_id_by_counter(user_counter)
+    telegram_id = get_telegram_id_by_counter(app, user_counter)
     
     if not telegram_id:
-        available_ids = sorted(user_id_map.values())
+        available_ids = sorted(app.user_id_map.values())
         ids_text = ", ".join(str(uid) for uid in available_ids[:20])
         if len(available_ids) > 20:
             ids_text += f"... и ещё {len(available_ids) - 20}"
@@ -327,81 +1520,110 @@ async def admin_reply(message: types.Message):
         )
         return
     
-    reply_id = get_next_reply_id()
+    await send_reply(app, message, telegram_id, user_counter, reply_text)
+
+async def send_reply(app: BotApp, message: types.Message, telegram_id: int, user_counter: int, reply_text: str):
+    """Пересылает ответ админа пользователю тем же типом медиа, что прислал админ"""
+    reply_id = get_next_reply_id(app)
     
     try:
         reply_header = f"✉️ {hbold('Ответ от администратора #' + str(reply_id) + ':')}\n\n"
         
         if message.photo:
             photo = message.photo[-1]
-            await bot.send_photo(
+            await app.bot.send_photo(
                 chat_id=telegram_id,
                 photo=photo.file_id,
                 caption=f"{reply_header}{reply_text}",
                 parse_mode="HTML"
             )
         elif message.video:
-            await bot.send_video(
+            await app.bot.send_video(
                 chat_id=telegram_id,
                 video=message.video.file_id,
                 caption=f"{reply_header}{reply_text}",
                 parse_mode="HTML"
             )
         elif message.video_note:
-            await bot.send_video_note(
+            await app.bot.send_video_note(
                 chat_id=telegram_id,
                 video_note=message.video_note.file_id
             )
             if reply_text:
-                await bot.send_message(
+                await app.bot.send_message(
                     chat_id=telegram_id,
                     text=f"{reply_header}{reply_text}",
                     parse_mode="HTML"
                 )
         elif message.document:
-            await bot.send_document(
+            await app.bot.send_document(
                 chat_id=telegram_id,
                 document=message.document.file_id,
                 caption=f"{reply_header}{reply_text}",
                 parse_mode="HTML"
             )
         elif message.voice:
-            await bot.send_voice(
+            await app.bot.send_voice(
                 chat_id=telegram_id,
                 voice=message.voice.file_id,
                 caption=f"{reply_header}{reply_text}",
                 parse_mode="HTML"
             )
         elif message.audio:
-            await bot.send_audio(
+            await app.bot.send_audio(
                 chat_id=telegram_id,
                 audio=message.audio.file_id,
                 caption=f"{reply_header}{reply_text}",
                 parse_mode="HTML"
             )
         elif message.animation:
-            await bot.send_animation(
+            await app.bot.send_animation(
                 chat_id=telegram_id,
                 animation=message.animation.file_id,
                 caption=f"{reply_header}{reply_text}",
                 parse_mode="HTML"
             )
         else:
-            await bot.send_message(
+            await app.bot.send_message(
                 chat_id=telegram_id,
                 text=f"{reply_header}{reply_text}",
                 parse_mode="HTML"
             )
         
         await message.answer(f"✅ Ответ #{reply_id} отправлен пользователю #{user_counter}")
-        
+    
     except Exception as e:
-        await message.answer(f"❌ Ошибка отправки: {e}")
+        status = classify_send_error(e)
+        if status:
+            await message.answer(f"🚫 Пользователь #{user_counter} недоступен: {UNREACHABLE_TITLES[status]}")
+        else:
+            await message.answer(f"❌ Ошибка отправки: {e}")
+
+# ---------------- ОТВЕТ ЦИТАТОЙ ----------------
+def remember_preview(app: BotApp, chat_id: int, message_ids: list, user_msg: dict):
+    """Запоминает сообщения карточки заявки у админа: ответ на любое из них уйдёт автору.
+    Хранится не больше REPLY_INDEX_SIZE сообщений, самые старые вытесняются"""
+    target = (user_msg['telegram_id'], user_msg['user_id_counter'], user_msg['post_id'])
+    for message_id in message_ids:
+        app.reply_index[(chat_id, message_id)] = target
+    while len(app.reply_index) > REPLY_INDEX_SIZE:
+        del app.reply_index[next(iter(app.reply_index))]
+
+def quoted_submission(message: types.Message, app: BotApp):
+    """Фильтр: админ ответил на карточку заявки. Отдаёт обработчику автора заявки"""
+    if message.from_user.id not in app.admins or not message.reply_to_message:
+        return False
+    target = app.reply_index.get((message.chat.id, message.reply_to_message.message_id))
+    return {'quoted': target} if target else False
+
+async def quote_reply(message: types.Message, quoted: tuple, app: BotApp):
+    """Ответ цитатой на карточку заявки - то же, что /reply с ID автора"""
+    telegram_id, user_counter = quoted[:2]
+    await send_reply(app, message, telegram_id, user_counter, message.text or message.caption or "")
 
 # ---------------- ТЕСТ ПОЛЬЗОВАТЕЛЯ ----------------
-@dp.message(Command("test_user"))
-async def test_user(message: types.Message):
-    if message.from_user.id not in ADMINS:
+async def test_user(message: types.Message, app: BotApp):
+    if message.from_user.id not in app.admins:
         return
     
     try:
@@ -411,13 +1633,13 @@ async def test_user(message: types.Message):
             return
         
         user_counter = int(args[1])
-        telegram_id = get_telegram_id_by_counter(user_counter)
+        telegram_id = get_telegram_id_by_counter(app, user_counter)
         
         if not telegram_id:
             await message.answer(f"❌ Пользователь с ID {user_counter} не найден")
             return
         
-        await bot.send_message(
+        await app.bot.send_message(
             telegram_id,
             f"🧪 {hbold('Тестовое сообщение от администратора')}\n\n"
             f"Если вы это видите - отправка работает! ✅",
@@ -425,52 +1647,395 @@ async def test_user(message: types.Message):
         )
         
         await message.answer(f"✅ Тест отправлен пользователю #{user_counter}")
-        
+    
     except ValueError:
         await message.answer("❌ ID должен быть числом")
     except Exception as e:
         await message.answer(f"❌ Ошибка: {e}")
 
 # ---------------- СТАТИСТИКА ----------------
-@dp.message(Command("stats"))
-async def stats(message: types.Message):
-    if message.from_user.id not in ADMINS:
+async def stats(message: types.Message, app: BotApp):
+    if message.from_user.id not in app.admins:
         return
     
-    posts = 0
-    if os.path.exists(POST_COUNTER_FILE):
-        with open(POST_COUNTER_FILE, "r") as f:
-            try:
-                posts = int(f.read().strip()) - 1
-            except:
-                posts = 0
-    
-    replies = 0
-    if os.path.exists(REPLY_COUNTER_FILE):
-        with open(REPLY_COUNTER_FILE, "r") as f:
-            try:
-                replies = int(f.read().strip()) - 1
-            except:
-                replies = 0
+    posts = peek_counter(app.post_counter_file)
+    replies = peek_counter(app.reply_counter_file)
     
     await message.answer(
         f"📊 {hbold('СТАТИСТИКА')}\n"
         f"━━━━━━━━━━━━━━\n"
-        f"👥 Пользователей: {len(user_id_map)}\n"
+        f"👥 Пользователей: {len(app.user_id_map)}\n"
+        f"├ ✅ Доступны: {len(app.user_id_map) - count_unreachable(app)}\n"
+        f"└ 🚫 Недоступны: {count_unreachable(app)}\n"
         f"📝 Опубликовано: {posts}\n"
         f"💬 Ответов: {replies}\n"
         f"━━━━━━━━━━━━━━",
         parse_mode="HTML"
     )
 
-@dp.message(Command("check_ids"))
-async def check_ids(message: types.Message):
-    if message.from_user.id not in ADMINS:
+async def api_stats(message: types.Message, app: BotApp):
+    if message.from_user.id not in app.admins:
+        return
+    
+    if not api_retry.stats:
+        await message.answer("📡 Вызовов Bot API ещё не было")
+        return
+    
+    text = f"📡 {hbold('BOT API')}\n"
+    text += "━━━━━━━━━━━━━━\n"
+    text += "Метод | вызовы | повторы | ошибки | отклонено\n"
+    for name, stat in sorted(api_retry.stats.items(), key=lambda x: -x[1]['calls']):
+        mark = " 🔴" if api_retry.is_open(name) else ""
+        text += f"{name}: {stat['calls']} | {stat['retries']} | {stat['failures']} | {stat['rejected']}{mark}\n"
+    text += "━━━━━━━━━━━━━━"
+    
+    await message.answer(text, parse_mode="HTML")
+
+async def task_status(message: types.Message, app: BotApp):
+    if message.from_user.id not in app.admins:
+        return
+    
+    if not app.tasks.stats:
+        await message.answer("⚙️ Фоновых задач ещё не было")
+        return
+    
+    text = f"⚙️ {hbold('ФОНОВЫЕ ЗАДАЧИ')}\n"
+    text += "━━━━━━━━━━━━━━\n"
+    text += "Задача | работают | запусков | время | ошибок | перезапусков\n"
+    for name, stat in sorted(app.tasks.stats.items()):
+        text += (f"{hcode(name)}: {stat['running']} | {stat['started']} | {format_duration(TaskSupervisor.runtime(stat))} | "
+                 f"{stat['failures']} | {stat['restarts']}\n")
+        if stat['last_error']:
+            failed_at, error = stat['last_error']
+            text += f"   ⚠️ {datetime.fromtimestamp(failed_at).strftime('%d.%m %H:%M')} {hitalic(error[:150])}\n"
+    text += "━━━━━━━━━━━━━━"
+    
+    await message.answer(text, parse_mode="HTML")
+
+async def loop_status(message: types.Message, app: BotApp):
+    if message.from_user.id not in app.admins:
+        return
+    
+    lags = loop_watchdog.lags
+    text = f"⏳ {hbold('ЗАДЕРЖКА EVENT LOOP')}\n"
+    text += "━━━━━━━━━━━━━━\n"
+    text += (f"p50 {percentile(lags, 0.5) * 1000:.1f} · p95 {percentile(lags, 0.95) * 1000:.1f} · "
+             f"p99 {percentile(lags, 0.99) * 1000:.1f} · макс {loop_watchdog.max_lag * 1000:.0f} мс\n")
+    text += f"Замеров: {len(lags)} · зависаний дольше {LOOP_LAG_THRESHOLD} сек.: {loop_watchdog.stall_count}\n"
+    
+    if loop_watchdog.sites:
+        text += f"\n{hbold('Где зависал:')}\n"
+        for site, count in sorted(loop_watchdog.sites.items(), key=lambda x: -x[1])[:10]:
+            text += f"{hcode(site)} - {count}\n"
+    if loop_watchdog.stalls:
+        text += f"\n{hbold('Последние:')}\n"
+        for stall in list(loop_watchdog.stalls)[-5:]:
+            text += f"{datetime.fromtimestamp(stall['ts']).strftime('%H:%M:%S')} · {stall['lag']:.2f} сек. · {hcode(stall['site'])}\n"
+    text += "━━━━━━━━━━━━━━"
+    
+    await message.answer(text, parse_mode="HTML")
+
+async def show_schedule(message: types.Message, app: BotApp):
+    if message.from_user.id not in app.admins:
+        return
+    
+    if not app.schedule_heap:
+        await message.answer("🕒 Очередь публикаций пуста")
+        return
+    
+    text = f"🕒 {hbold('ОЧЕРЕДЬ ПУБЛИКАЦИЙ')} ({len(app.schedule_heap)})\n"
+    text += "━━━━━━━━━━━━━━\n"
+    for due, submission_id, publication in heapq.nsmallest(30, app.schedule_heap):
+        text += f"{format_slot(due)} · 📝 #{publication['post_id']} · 🆔 {publication['user_id_counter']}\n"
+    text += "━━━━━━━━━━━━━━\n"
+    text += f"Интервал: {SLOT_SPACING // 60} мин. · тихие часы: {QUIET_HOURS_START}:00-{QUIET_HOURS_END}:00"
+    
+    await message.answer(text, parse_mode="HTML")
+
+# ---------------- ОТЛАДКА ПАМЯТИ ----------------
+# Хранилища BotApp, которые растут вместе с нагрузкой
+MEMORY_STORES = (
+    ('media_groups', "альбомы в сборке"),
+    ('user_messages', "заявки на модерации"),
+    ('digest_queue', "очередь сводки"),
+    ('digest_messages', "сообщения сводки"),
+    ('user_id_map', "ID пользователей"),
+    ('reachability', "доступность"),
+    ('submission_locks', "блокировки заявок"),
+    ('submission_claims', "захваты заявок"),
+    ('schedule_heap', "расписание"),
+    ('pull_heap', "очередь /next"),
+    ('search_index', "поисковый индекс"),
+    ('search_queries', "запросы поиска"),
+    ('reply_index', "ответы цитатой")
+)
+MEMORY_TOP = 25  # строк в топах tracemalloc
+
+# Объекты, в которые обход не заходит: общие для всего процесса, их размер к хранилищу не относится
+DEEP_SIZE_SKIP = (type, type(sys), Bot, Dispatcher, BotApp, asyncio.AbstractEventLoop, asyncio.Future, asyncio.Handle, threading.Thread)
+
+# tracemalloc общий на процесс; последний снимок - база для сравнения
+memory_debug = {'snapshot': None, 'taken_at': None}
+
+def deep_size(obj) -> tuple:
+    """(байт, объектов) с учётом вложенных объектов; общие объекты считаются один раз.
+    Обход без рекурсии, копии контейнеров снимаются перед обходом - их могут менять"""
+    seen = set()
+    stack = [obj]
+    size = count = 0
+    while stack:
+        current = stack.pop()
+        if id(current) in seen or isinstance(current, DEEP_SIZE_SKIP) or callable(current):
+            continue
+        seen.add(id(current))
+        size += sys.getsizeof(current)
+        count += 1
+        
+        if isinstance(current, (str, bytes, bytearray, int, float, bool, array)) or current is None:
+            continue
+        if isinstance(current, dict):
+            for key, value in list(current.items()):
+                stack.append(key)
+                stack.append(value)
+        elif isinstance(current, (list, tuple, set, frozenset, deque)):
+            stack.extend(list(current))
+        else:
+            if hasattr(current, '__dict__'):
+                stack.append(current.__dict__)
+            for slot in getattr(type(current), '__slots__', ()):
+                if slot != '__dict__' and hasattr(current, slot):
+                    stack.append(getattr(current, slot))
+    return size, count
+
+def process_memory() -> str:
+    """Текущий и пиковый RSS процесса из /proc (только Linux)"""
+    try:
+        with open("/proc/self/status") as f:
+            fields = dict(line.split(":", 1) for line in f if ":" in line)
+        return f"RSS {fields['VmRSS'].strip()}, пик {fields['VmHWM'].strip()}"
+    except (OSError, KeyError):
+        return "RSS недоступен"
+
+def format_bytes(size: float) -> str:
+    for unit in ("Б", "КБ", "МБ"):
+        if abs(size) < 1024:
+            return f"{size:.0f} {unit}"
+        size /= 1024
+    return f"{size:.1f} ГБ"
+
+def memory_report(app: BotApp) -> str:
+    """Текст отчёта. Долгий (обход всех хранилищ и снимок), вызывается в отдельном потоке"""
+    lines = [
+        f"Отчёт о памяти, {datetime.now().strftime('%d.%m.%Y %H:%M:%S')}",
+        f"Процесс: {process_memory()}",
+        "",
+        f"== Хранилища бота {app.bot.id if app.bot else ''} (каждое считается отдельно) =="
+    ]
+    for attr, title in MEMORY_STORES:
+        store = getattr(app, attr)
+        size, count = deep_size(store)
+        lines.append(f"{attr:<20} {title:<22} {len(store):>9} записей "
+                     f"{format_bytes(size):>10} ({count} объектов)")
+    
+    lines.append("")
+    if not tracemalloc.is_tracing():
+        lines.append("tracemalloc выключен: /debug_mem start [кадров] (или PYTHONTRACEMALLOC=1 при запуске)")
+        return "\n".join(lines)
+    
+    current, peak = tracemalloc.get_traced_memory()
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<unknown>")
+    ))
+    lines.append(f"== tracemalloc: сейчас {format_bytes(current)}, пик {format_bytes(peak)}, "
+                 f"кадров {tracemalloc.get_traceback_limit()} ==")
+    lines.append(f"-- Больше всего памяти (топ {MEMORY_TOP}) --")
+    for stat in snapshot.statistics('lineno')[:MEMORY_TOP]:
+        lines.append(str(stat))
+    
+    previous, taken_at = memory_debug['snapshot'], memory_debug['taken_at']
+    lines.append("")
+    if previous is None:
+        lines.append("-- Рост: первый снимок, сравнение будет в следующем отчёте --")
+    else:
+        lines.append(f"-- Рост с {taken_at.strftime('%d.%m %H:%M:%S')} (топ {MEMORY_TOP}) --")
+        for stat in snapshot.compare_to(previous, 'lineno')[:MEMORY_TOP]:
+            if stat.size_diff <= 0:
+                break
+            lines.append(str(stat))
+    memory_debug['snapshot'] = snapshot
+    memory_debug['taken_at'] = datetime.now()
+    return "\n".join(lines)
+
+async def debug_mem(message: types.Message, app: BotApp):
+    """/debug_mem - отчёт файлом; /debug_mem start [кадров] и stop - tracemalloc"""
+    if message.from_user.id not in app.admins:
+        return
+    
+    args = message.text.split()[1:]
+    if args and args[0] == "start":
+        try:
+            frames = int(args[1]) if len(args) > 1 else 1
+        except ValueError:
+            await message.answer("❌ Формат: /debug_mem start [кадров]")
+            return
+        if tracemalloc.is_tracing():
+            await message.answer("ℹ️ tracemalloc уже включён")
+            return
+        tracemalloc.start(frames)
+        await message.answer(f"✅ tracemalloc включён ({frames} кадр.). Учитываются только новые выделения, "
+                             f"работа бота замедлится")
+        return
+    if args and args[0] == "stop":
+        tracemalloc.stop()
+        memory_debug['snapshot'] = memory_debug['taken_at'] = None
+        await message.answer("✅ tracemalloc выключен, снимки удалены")
+        return
+    
+    status_msg = await message.answer("🧮 Считаю память...")
+    try:
+        report = await asyncio.to_thread(memory_report, app)
+        await message.answer_document(
+            BufferedInputFile(report.encode(), filename=f"memory-{datetime.now().strftime('%Y%m%d-%H%M%S')}.txt"),
+            caption=f"🧮 {process_memory()}"
+        )
+        await status_msg.delete()
+    except Exception as e:
+        logging.error(f"Ошибка отчёта о памяти: {e}")
+        await status_msg.edit_text(f"❌ Ошибка: {str(e)[:100]}")
+
+# ---------------- ИСТОРИЯ ПОСТОВ ----------------
+def format_event_time(ts: int) -> str:
+    return datetime.fromtimestamp(ts).strftime("%d.%m %H:%M")
+
+async def post_history(message: types.Message, app: BotApp):
+    if message.from_user.id not in app.admins:
+        return
+    
+    try:
+        post_id = int(message.text.split()[1])
+    except (IndexError, ValueError):
+        await message.answer("❌ Используйте: /post <номер>")
+        return
+    
+    events = await asyncio.to_thread(app.event_log.post_events, post_id)
+    if not events:
+        await message.answer(f"❌ Пост №{post_id} не найден в журнале")
+        return
+    
+    text = f"📜 {hbold('ПОСТ #' + str(post_id))}\n"
+    text += "━━━━━━━━━━━━━━\n"
+    for event in reversed(events):
+        line = f"{format_event_time(event['ts'])} {EVENT_TITLES.get(event['event'], event['event'])}"
+        if event['event'] == 'submit':
+            line += f" · 🆔 {event['user_id_counter']} · 📱 {event['telegram_id']} · 📎 {event['content_type']}"
+            if event.get('text'):
+                line += f"\n   {hitalic(event['text'][:100])}"
+        elif 'admin' in event:
+            line += f" · 👮 {event['admin']}"
+        text += line + "\n"
+    text += "━━━━━━━━━━━━━━"
+    
+    # Опубликованный и не удалённый пост можно удалить прямо отсюда
+    published = app.post_archive.by_post(post_id)
+    markup = None
+    if published:
+        state = "удалён из канала" if published['deleted'] else f"в канале, сообщений: {len(published['message_ids'])}"
+        text += f"\n📺 {state}"
+        if not published['deleted']:
+            markup = published_keyboard(published['submission_id'])
+    
+    await message.answer(text, reply_markup=markup, parse_mode="HTML")
+
+async def user_posts(message: types.Message, app: BotApp):
+    if message.from_user.id not in app.admins:
+        return
+    
+    try:
+        user_counter = int(message.text.split()[1])
+    except (IndexError, ValueError):
+        await message.answer("❌ Используйте: /user_posts <ID>")
+        return
+    
+    submissions = await asyncio.to_thread(app.event_log.user_submissions, user_counter)
+    if not submissions:
+        await message.answer(f"❌ У пользователя #{user_counter} нет постов в журнале")
+        return
+    
+    text = f"🗂 {hbold('ПОСТЫ ПОЛЬЗОВАТЕЛЯ #' + str(user_counter))}\n"
+    text += "━━━━━━━━━━━━━━\n"
+    for event in submissions:
+        text += (
+            f"📝 #{event['post_id']} · {format_event_time(event['ts'])} · "
+            f"{EVENT_TITLES.get(event['status'], event['status'])}\n"
+        )
+        if event.get('text'):
+            text += f"   {hitalic(event['text'][:60])}\n"
+    text += "━━━━━━━━━━━━━━"
+    
+    await message.answer(text, parse_mode="HTML")
+
+# ---------------- ПОИСК ПО ЗАЯВКАМ И ПОСТАМ ----------------
+def render_search(app: BotApp, query_id: int, page: int):
+    """Текст и кнопки одной страницы результатов"""
+    query = app.search_queries[query_id]
+    started = time.perf_counter()
+    total, found, complete = app.search_index.search(query, (page + 1) * SEARCH_PAGE_SIZE)
+    elapsed = (time.perf_counter() - started) * 1000
+    
+    if not total:
+        return f"🔍 По запросу {hitalic(query)} ничего не найдено", None
+    
+    pages = (total + SEARCH_PAGE_SIZE - 1) // SEARCH_PAGE_SIZE
+    text = f"🔍 {hbold('ПОИСК')}: {hitalic(query)}\n"
+    text += "━━━━━━━━━━━━━━\n"
+    for post_id in found[page * SEARCH_PAGE_SIZE:]:
+        status, snippet, _ = app.search_index.docs[post_id]
+        text += f"📝 #{post_id} · {SEARCH_STATUS_TITLES[status]}\n"
+        if snippet:
+            text += f"   {hitalic(snippet)}\n"
+    text += "━━━━━━━━━━━━━━\n"
+    text += f"Найдено: {total}{'' if complete else '+'} · стр. {page + 1}/{pages} · {elapsed:.2f} мс"
+    return text, search_keyboard(query_id, page, pages)
+
+async def search(message: types.Message, app: BotApp):
+    if message.from_user.id not in app.admins:
+        return
+    
+    parts = message.text.split(maxsplit=1)
+    if len(parts) < 2:
+        await message.answer("❌ Используйте: /search <слова>")
+        return
+    
+    app.search_query_seq += 1
+    app.search_queries[app.search_query_seq] = parts[1]
+    if len(app.search_queries) > 100:
+        del app.search_queries[next(iter(app.search_queries))]
+    
+    text, markup = render_search(app, app.search_query_seq, 0)
+    await message.answer(text, reply_markup=markup, parse_mode="HTML")
+
+async def search_page(cb: types.CallbackQuery, callback_data: SearchCallback, app: BotApp):
+    if cb.from_user.id not in app.admins:
+        return
+    if callback_data.query_id not in app.search_queries:
+        await cb.answer("❌ Поиск устарел, повторите /search")
+        return
+    
+    text, markup = render_search(app, callback_data.query_id, callback_data.page)
+    try:
+        await cb.message.edit_text(text, reply_markup=markup, parse_mode="HTML")
+    except TelegramBadRequest:
+        pass
+    await cb.answer()
+
+async def check_ids(message: types.Message, app: BotApp):
+    if message.from_user.id not in app.admins:
         return
-    global user_id_map
-    old_count = len(user_id_map)
-    user_id_map = check_duplicate_ids()
-    new_count = len(user_id_map)
+    old_count = len(app.user_id_map)
+    app.user_id_map = check_duplicate_ids(app)
+    new_count = len(app.user_id_map)
     
     await message.answer(
         f"✅ Проверка завершена\n"
@@ -478,12 +2043,11 @@ async def check_ids(message: types.Message):
         parse_mode="HTML"
     )
 
-@dp.message(Command("list_users"))
-async def list_users(message: types.Message):
-    if message.from_user.id not in ADMINS:
+async def list_users(message: types.Message, app: BotApp):
+    if message.from_user.id not in app.admins:
         return
     
-    if not user_id_map:
+    if not app.user_id_map:
         await message.answer("❌ Нет пользователей")
         return
     
@@ -492,7 +2056,7 @@ async def list_users(message: types.Message):
     text += "Внутр.ID | Telegram ID\n"
     text += "━━━━━━━━━━━━━━━━━━━━━\n"
     
-    sorted_users = sorted(user_id_map.items(), key=lambda x: x[1])
+    sorted_users = sorted(app.user_id_map.items(), key=lambda x: x[1])
     for tid, uid in sorted_users:
         text += f"{uid:7} | {tid}\n"
         if len(text) > 3500:
@@ -501,37 +2065,76 @@ async def list_users(message: types.Message):
     
     await message.answer(text, parse_mode="HTML")
 
-@dp.message(Command("myid"))
-async def my_id(message: types.Message):
-    user_counter = get_user_id_counter(message.from_user.id)
+async def my_id(message: types.Message, app: BotApp):
+    user_counter = get_user_id_counter(app, message.from_user.id)
     await message.answer(f"🆔 {hbold('Ваш внутренний ID:')} {hcode(str(user_counter))}", parse_mode="HTML")
 
-@dp.message(Command("toggle_accept"))
-async def toggle_accept(message: types.Message):
-    if message.from_user.id not in ADMINS:
+async def toggle_accept(message: types.Message, app: BotApp):
+    if message.from_user.id not in app.admins:
         return
     
-    new_mode = not is_admin_accepting()
-    set_admin_accepting(new_mode)
+    new_mode = not is_admin_accepting(app)
+    set_admin_accepting(app, new_mode)
     await message.answer(
         f"🔄 {hbold('Режим приема от админа')}\n"
         f"{'✅ ВКЛЮЧЕН' if new_mode else '❌ ВЫКЛЮЧЕН'}",
         parse_mode="HTML"
     )
 
-@dp.message(Command("broadcast"))
-async def broadcast(message: types.Message):
-    if message.from_user.id not in ADMINS:
+async def toggle_digest(message: types.Message, app: BotApp):
+    if message.from_user.id not in app.admins:
+        return
+    
+    new_mode = not is_digest_mode(app)
+    set_digest_mode(app, new_mode)
+    if not new_mode:
+        # Не держим накопленные заявки до конца окна
+        await flush_digest(app)
+    await message.answer(
+        f"📬 {hbold('Режим сводки заявок')}\n"
+        f"{'✅ ВКЛЮЧЕН' if new_mode else '❌ ВЫКЛЮЧЕН'}\n"
+        f"⏱ Окно: {DIGEST_WINDOW} сек.",
+        parse_mode="HTML"
+    )
+
+async def intake_status(message: types.Message, app: BotApp):
+    if message.from_user.id not in app.admins:
+        return
+    
+    stats = app.intake_stats
+    waits = app.intake_waits
+    await message.answer(
+        f"📥 {hbold('ОЧЕРЕДЬ ПРИЁМА')}\n"
+        f"━━━━━━━━━━━━━━\n"
+        f"📦 В очереди: {app.intake.qsize()} / {INTAKE_QUEUE_SIZE}\n"
+        f"⏭ Ждут /next: {pull_waiting(app)}{' (режим очереди включён)' if is_pull_mode(app) else ''}\n"
+        f"📬 Порог сводки: {INTAKE_HIGH_WATER} · 👷 Воркеров: {INTAKE_WORKERS}\n"
+        f"📨 Принято в очередь: {stats['queued']}\n"
+        f"├ 📬 В сводку из-за нагрузки: {stats['shed']}\n"
+        f"└ ⚠️ Мимо переполненной очереди: {stats['overflow']}\n"
+        f"⏱ Ожидание: p50 {percentile(waits, 0.5):.2f} · p95 {percentile(waits, 0.95):.2f} · "
+        f"макс {max(waits, default=0):.2f} сек.\n"
+        f"━━━━━━━━━━━━━━",
+        parse_mode="HTML"
+    )
+
+async def broadcast(message: types.Message, app: BotApp):
+    if message.from_user.id not in app.admins:
         return
     
     if not message.reply_to_message:
         await message.answer("❌ Ответьте на сообщение для рассылки")
         return
     
-    users = list(user_id_map.keys())
-    if not users:
+    # "/broadcast all" - писать и тем, кто числится недоступным
+    include_dead = len(message.text.split()) > 1 and message.text.split()[1] == "all"
+    
+    all_users = list(app.user_id_map.keys())
+    if not all_users:
         await message.answer("❌ Нет пользователей")
         return
+    users = all_users if include_dead else [uid for uid in all_users if is_reachable(app, uid)]
+    skipped = len(all_users) - len(users)
     
     status_msg = await message.answer("📤 Начинаю рассылку...")
     success = 0
@@ -539,8 +2142,8 @@ async def broadcast(message: types.Message):
     
     for uid in users:
         try:
-            await bot.send_message(uid, f"📢 {hbold('Сообщение от администратора:')}", parse_mode="HTML")
-            await bot.copy_message(
+            await app.bot.send_message(uid, f"📢 {hbold('Сообщение от администратора:')}", parse_mode="HTML")
+            await app.bot.copy_message(
                 chat_id=uid,
                 from_chat_id=message.chat.id,
                 message_id=message.reply_to_message.message_id
@@ -556,43 +2159,43 @@ async def broadcast(message: types.Message):
         f"📊 Статистика:\n"
         f"✓ Успешно: {success}\n"
         f"✗ Ошибок: {failed}\n"
-        f"👥 Всего: {len(users)}",
+        f"⏭ Пропущено недоступных: {skipped}\n"
+        f"👥 Всего: {len(all_users)}\n\n"
+        f"✅ Доступны: {len(all_users) - count_unreachable(app)} | 🚫 Недоступны: {count_unreachable(app)}",
         parse_mode="HTML"
     )
 
 # ---------------- ОБРАБОТКА МЕДИА ГРУПП (АЛЬБОМОВ) ----------------
-@dp.message(F.media_group_id)
-async def handle_media_group(message: types.Message):
+async def handle_media_group(message: types.Message, app: BotApp):
     """Обработка альбомов (несколько фото/видео)"""
     
     telegram_id = message.from_user.id
     
-    if telegram_id in ADMINS and not is_admin_accepting():
+    if telegram_id in app.admins and not is_admin_accepting(app):
         return
     
     media_group_id = message.media_group_id
     
-    if media_group_id not in media_groups:
-        media_groups[media_group_id] = {
+    if media_group_id not in app.media_groups:
+        app.media_groups[media_group_id] = {
             'messages': [],
             'timer': None,
             'user_id': telegram_id,
             'first_message': message
         }
     
-    media_groups[media_group_id]['messages'].append(message)
+    app.media_groups[media_group_id]['messages'].append(message)
     
-    if media_groups[media_group_id]['timer']:
-        media_groups[media_group_id]['timer'].cancel()
+    if app.media_groups[media_group_id]['timer']:
+        app.media_groups[media_group_id]['timer'].cancel()
     
-    loop = asyncio.get_event_loop()
-    timer = loop.call_later(1.0, lambda: asyncio.create_task(process_media_group(media_group_id)))
-    media_groups[media_group_id]['timer'] = timer
+    timer = app.tasks.call_later("album", 1.0, partial(process_media_group, app, media_group_id))
+    app.media_groups[media_group_id]['timer'] = timer
 
-async def process_media_group(media_group_id: str):
+async def process_media_group(app: BotApp, media_group_id: str):
     """Обработка собранного альбома"""
     
-    group_data = media_groups.get(media_group_id)
+    group_data = app.media_groups.get(media_group_id)
     if not group_data:
         return
     
@@ -602,15 +2205,15 @@ async def process_media_group(media_group_id: str):
     messages.sort(key=lambda x: x.date)
     
     telegram_id = group_data['user_id']
-    user_id_counter = get_user_id_counter(telegram_id)
-    post_id = get_next_post_id()
-    unique_id = str(uuid.uuid4())
+    user_id_counter = get_user_id_counter(app, telegram_id)
+    post_id = get_next_post_id(app)
+    submission_id = get_next_submission_id(app)
     
     user = first_msg.from_user
     username = f"@{user.username}" if user.username else "❌ Нет username"
     full_name = user.full_name or "Не указано"
     
-    user_messages[unique_id] = {
+    app.user_messages[submission_id] = {
         'type': 'media_group',
         'media_group_id': media_group_id,
         'messages': messages,
@@ -618,461 +2221,1040 @@ async def process_media_group(media_group_id: str):
         'user_id_counter': user_id_counter,
         'post_id': post_id,
         'telegram_id': telegram_id,
-        'unique_id': unique_id
+        'submission_id': submission_id,
+        'username': username,
+        'full_name': full_name,
+        'received': time.time()
     }
     
-    for admin in ADMINS:
-        try:
-            text = (
-                "━━━━━━━━━━━━━━━━━━━━━\n"
-                "📨 **ПРИШЛО АНОНИМНОЕ СООБЩЕНИЕ (АЛЬБОМ)**\n"
-                "━━━━━━━━━━━━━━━━━━━━━\n\n"
-                
-                "👤 **ИНФОРМАЦИЯ О ПОЛЬЗОВАТЕЛЕ:**\n"
-                f"├ 🆔 Внутренний ID: `{user_id_counter}`\n"
-                f"├ 📱 Telegram ID: `{telegram_id}`\n"
-                f"├ 👤 Имя: `{full_name}`\n"
-                f"└ 🔗 Username: {username}\n\n"
-                
-                "📬 **ИНФОРМАЦИЯ О ПОСТЕ:**\n"
-                f"├ 📝 Номер поста: `{post_id}`\n"
-                f"├ 🆔 Уникальный ID: `{unique_id[:8]}...`\n"
-                f"└ 🖼 Медиа в альбоме: `{len(messages)}`\n"
-                "━━━━━━━━━━━━━━━━━━━━━"
-            )
-            
-            await bot.send_message(admin, text, parse_mode="Markdown")
-            
-            media_group = []
-            
-            for i, msg in enumerate(messages):
-                if msg.photo:
-                    file_id = msg.photo[-1].file_id
-                    if i == 0:
-                        media_group.append(
-                            InputMediaPhoto(
-                                media=file_id,
-                                caption=first_msg.caption or f"📸 Альбом | Пост #{post_id}",
-                                parse_mode="HTML"
-                            )
-                        )
-                    else:
-                        media_group.append(
-                            InputMediaPhoto(
-                                media=file_id
-                            )
-                        )
-                elif msg.video:
-                    file_id = msg.video.file_id
-                    if i == 0:
-                        media_group.append(
-                            InputMediaVideo(
-                                media=file_id,
-                                caption=first_msg.caption or f"🎬 Альбом | Пост #{post_id}",
-                                parse_mode="HTML"
-                            )
-                        )
-                    else:
-                        media_group.append(
-                            InputMediaVideo(
-                                media=file_id
-                            )
-                        )
-            
-            if media_group:
-                await bot.send_media_group(admin, media_group)
-            
-            await bot.send_message(
-                admin,
-                f"🆔 ID пользователя: `{user_id_counter}` | Пост №`{post_id}` | Уникальный ID: `{unique_id[:8]}`",
-                reply_markup=admin_keyboard(user_id_counter, post_id, unique_id),
-                parse_mode="Markdown"
-            )
-            
-        except Exception as e:
-            logging.error(f"Ошибка отправки альбома админу {admin}: {e}")
+    app.event_log.record(
+        'submit', post_id,
+        user_id_counter=user_id_counter,
+        telegram_id=telegram_id,
+        content_type='media_group',
+        media=len(messages),
+        text=(first_msg.caption or '')[:200]
+    )
+    app.search_index.add(post_id, first_msg.caption or '', 'pending')
+    
+    enqueue_submission(app, submission_id)
     
     await first_msg.reply(f"✅ Ваш альбом №{post_id} отправлен на модерацию!")
-    del media_groups[media_group_id]
+    del app.media_groups[media_group_id]
 
-# ---------------- ОБРАБОТКА ВСЕХ ТИПОВ СООБЩЕНИЙ ----------------
-@dp.message(F.text | F.photo | F.video | F.video_note | F.document | F.voice | F.audio | F.animation)
-async def user_message(message: types.Message):
-    """Обработчик одиночных сообщений от пользователей"""
+# ---------------- КАРТОЧКИ ЗАЯВОК ДЛЯ АДМИНОВ ----------------
+async def send_album_card(app: BotApp, admin: int, user_msg: dict):
+    """Полная карточка альбома: заголовок, сами медиа и клавиатура"""
+    messages = user_msg['messages']
+    caption = user_msg['caption']
+    user_id_counter = user_msg['user_id_counter']
+    post_id = user_msg['post_id']
+    submission_id = user_msg['submission_id']
     
-    if message.media_group_id:
-        return
+    text = (
+        "━━━━━━━━━━━━━━━━━━━━━\n"
+        "📨 **ПРИШЛО АНОНИМНОЕ СООБЩЕНИЕ (АЛЬБОМ)**\n"
+        "━━━━━━━━━━━━━━━━━━━━━\n\n"
+        
+        "👤 **ИНФОРМАЦИЯ О ПОЛЬЗОВАТЕЛЕ:**\n"
+        f"├ 🆔 Внутренний ID: `{user_id_counter}`\n"
+        f"├ 📱 Telegram ID: `{user_msg['telegram_id']}`\n"
+        f"├ 👤 Имя: `{user_msg['full_name']}`\n"
+        f"└ 🔗 Username: {user_msg['username']}\n\n"
+        
+        "📬 **ИНФОРМАЦИЯ О ПОСТЕ:**\n"
+        f"├ 📝 Номер поста: `{post_id}`\n"
+        f"├ 🆔 Номер заявки: `{submission_id}`\n"
+        f"└ 🖼 Медиа в альбоме: `{len(messages)}`\n"
+        "━━━━━━━━━━━━━━━━━━━━━"
+    )
     
-    telegram_id = message.from_user.id
+    header = await app.bot.send_message(admin, text, parse_mode="Markdown")
+    preview_ids = [header.message_id]
     
-    if telegram_id in ADMINS and not is_admin_accepting():
-        return
+    media_group = []
     
-    if message.text and message.text.startswith('/'):
-        return
+    for i, msg in enumerate(messages):
+        if msg.photo:
+            file_id = msg.photo[-1].file_id
+            if i == 0:
+                media_group.append(
+                    InputMediaPhoto(
+                        media=file_id,
+                        caption=caption or f"📸 Альбом | Пост #{post_id}",
+                        parse_mode="HTML"
+                    )
+                )
+            else:
+                media_group.append(
+                    InputMediaPhoto(
+                        media=file_id
+                    )
+                )
+        elif msg.video:
+            file_id = msg.video.file_id
+            if i == 0:
+                media_group.append(
+                    InputMediaVideo(
+                        media=file_id,
+                        caption=caption or f"🎬 Альбом | Пост #{post_id}",
+                        parse_mode="HTML"
+                    )
+                )
+            else:
+                media_group.append(
+                    InputMediaVideo(
+                        media=file_id
+                    )
+                )
     
-    user_id_counter = get_user_id_counter(telegram_id)
-    post_id = get_next_post_id()
-    unique_id = str(uuid.uuid4())
+    if media_group:
+        sent = await app.bot.send_media_group(admin, media_group)
+        preview_ids.extend(msg.message_id for msg in sent)
     
-    user_messages[unique_id] = {
-        'chat_id': message.chat.id,
-        'message_id': message.message_id,
-        'content_type': message.content_type,
-        'text': message.text or message.caption or '',
-        'caption': message.caption or '',
-        'user_id_counter': user_id_counter,
-        'post_id': post_id,
-        'telegram_id': telegram_id,
-        'unique_id': unique_id
-    }
+    keyboard_msg = await app.bot.send_message(
+        admin,
+        f"🆔 ID пользователя: `{user_id_counter}` | Пост №`{post_id}` | Заявка №`{submission_id}`",
+        reply_markup=admin_keyboard(submission_id),
+        parse_mode="Markdown"
+    )
+    user_msg.setdefault('admin_messages', []).append((admin, keyboard_msg.message_id))
+    remember_preview(app, admin, preview_ids + [keyboard_msg.message_id], user_msg)
+
+async def send_message_card(app: BotApp, admin: int, user_msg: dict):
+    """Полная карточка одиночного сообщения: заголовок и копия с клавиатурой"""
+    user_id_counter = user_msg['user_id_counter']
+    post_id = user_msg['post_id']
+    submission_id = user_msg['submission_id']
     
-    if message.photo:
-        user_messages[unique_id]['media'] = message.photo[-1].file_id
-    elif message.video:
-        user_messages[unique_id]['media'] = message.video.file_id
-    elif message.video_note:
-        user_messages[unique_id]['media'] = message.video_note.file_id
-    elif message.document:
-        user_messages[unique_id]['media'] = message.document.file_id
-    elif message.voice:
-        user_messages[unique_id]['media'] = message.voice.file_id
-    elif message.audio:
-        user_messages[unique_id]['media'] = message.audio.file_id
-    elif message.animation:
-        user_messages[unique_id]['media'] = message.animation.file_id
+    text = (
+        "━━━━━━━━━━━━━━━━━━━━━\n"
+        "📨 **ПРИШЛО АНОНИМНОЕ СООБЩЕНИЕ**\n"
+        "━━━━━━━━━━━━━━━━━━━━━\n\n"
+        
+        "👤 **ИНФОРМАЦИЯ О ПОЛЬЗОВАТЕЛЕ:**\n"
+        f"├ 🆔 Внутренний ID: `{user_id_counter}`\n"
+        f"├ 📱 Telegram ID: `{user_msg['telegram_id']}`\n"
+        f"├ 👤 Имя: `{user_msg['full_name']}`\n"
+        f"└ 🔗 Username: {user_msg['username']}\n\n"
+        
+        "📬 **ИНФОРМАЦИЯ О ПОСТЕ:**\n"
+        f"├ 📝 Номер поста: `{post_id}`\n"
+        f"├ 🆔 Номер заявки: `{submission_id}`\n"
+        f"└ 📎 Тип: `{user_msg['content_type']}`\n"
+        "━━━━━━━━━━━━━━━━━━━━━"
+    )
     
-    user = message.from_user
-    username = f"@{user.username}" if user.username else "❌ Нет username"
-    full_name = user.full_name or "Не указано"
+    header = await app.bot.send_message(admin, text, parse_mode="Markdown")
+    
+    copy = await app.bot.copy_message(
+        chat_id=admin,
+        from_chat_id=user_msg['chat_id'],
+        message_id=user_msg['message_id'],
+        reply_markup=admin_keyboard(submission_id)
+    )
+    user_msg.setdefault('admin_messages', []).append((admin, copy.message_id))
+    remember_preview(app, admin, [header.message_id, copy.message_id], user_msg)
+
+async def send_submission_card(app: BotApp, admin: int, submission_id: int):
+    """Карточка - несколько сообщений подряд. Воркеры шлют заявки параллельно, поэтому
+    одному админу карточки идут по очереди: иначе заголовок с данными одного автора
+    окажется над сообщением другого. Разным админам - одновременно"""
+    user_msg = app.user_messages.get(submission_id)
+    if not user_msg:
+        return
+    lock = app.card_locks.setdefault(admin, asyncio.Lock())
+    async with lock:
+        if user_msg.get('type') == 'media_group':
+            await send_album_card(app, admin, user_msg)
+        else:
+            await send_message_card(app, admin, user_msg)
+
+async def notify_admins(app: BotApp, submission_id: int, digest: bool = False):
+    """Уведомление админов о новой заявке: сразу, через сводку или только счётчиком очереди /next"""
+    if is_pull_mode(app):
+        schedule_pull_counter(app)
+        return
+    if digest or is_digest_mode(app):
+        queue_for_digest(app, submission_id)
+        return
     
-    for admin in ADMINS:
+    for admin in app.admins:
         try:
-            text = (
-                "━━━━━━━━━━━━━━━━━━━━━\n"
-                "📨 **ПРИШЛО АНОНИМНОЕ СООБЩЕНИЕ**\n"
-                "━━━━━━━━━━━━━━━━━━━━━\n\n"
-                
-                "👤 **ИНФОРМАЦИЯ О ПОЛЬЗОВАТЕЛЕ:**\n"
-                f"├ 🆔 Внутренний ID: `{user_id_counter}`\n"
-                f"├ 📱 Telegram ID: `{telegram_id}`\n"
-                f"├ 👤 Имя: `{full_name}`\n"
-                f"└ 🔗 Username: {username}\n\n"
-                
-                "📬 **ИНФОРМАЦИЯ О ПОСТЕ:**\n"
-                f"├ 📝 Номер поста: `{post_id}`\n"
-                f"├ 🆔 Уникальный ID: `{unique_id[:8]}...`\n"
-                f"└ 📎 Тип: `{message.content_type}`\n"
-                "━━━━━━━━━━━━━━━━━━━━━"
-            )
-            
-            await bot.send_message(admin, text, parse_mode="Markdown")
-            
-            await bot.copy_message(
-                chat_id=admin,
-                from_chat_id=message.chat.id,
-                message_id=message.message_id,
-                reply_markup=admin_keyboard(user_id_counter, post_id, unique_id)
-            )
+            await send_submission_card(app, admin, submission_id)
         except Exception as e:
             logging.error(f"Ошибка отправки админу {admin}: {e}")
-    
-    await message.reply(f"✅ Ваше сообщение №{post_id} отправлено на модерацию!")
 
-# ---------------- ПУБЛИКАЦИЯ С ПОДДЕРЖКОЙ АЛЬБОМОВ ----------------
-@dp.callback_query(F.data.startswith("approve"))
-async def approve(cb: types.CallbackQuery):
-    try:
-        data = cb.data.split(":")
-        if len(data) < 4:
-            await cb.answer("❌ Ошибка в данных")
-            return
-            
-        user_id_counter = int(data[1])
-        post_id = int(data[2])
-        unique_id = data[3]
-    except (IndexError, ValueError):
-        await cb.answer("❌ Ошибка в данных")
+# ---------------- ОЧЕРЕДЬ ПРИЁМА ЗАЯВОК ----------------
+def enqueue_submission(app: BotApp, submission_id: int):
+    """Ставит заявку в очередь на рассылку админам; если очередь полна - сразу в сводку.
+    В режиме /next заявка только ждёт в куче, админам уходит лишь счётчик"""
+    if is_pull_mode(app):
+        push_pending(app, submission_id)
+        schedule_pull_counter(app)
         return
     
-    telegram_id = get_telegram_id_by_counter(user_id_counter)
-    if not telegram_id:
-        await cb.answer("❌ Пользователь не найден")
+    try:
+        app.intake.put_nowait((submission_id, time.monotonic()))
+        app.intake_stats['queued'] += 1
+    except asyncio.QueueFull:
+        app.intake_stats['overflow'] += 1
+        queue_for_digest(app, submission_id)
+
+async def intake_worker(app: BotApp):
+    """Рассылает заявки из очереди. Пока очередь выше INTAKE_HIGH_WATER,
+    заявки копятся в сводку: одно сообщение на пачку вместо карточки на каждую"""
+    while True:
+        submission_id, queued_at = await app.intake.get()
+        try:
+            app.intake_waits.append(time.monotonic() - queued_at)
+            if submission_id not in app.user_messages:
+                continue
+            overloaded = app.intake.qsize() >= INTAKE_HIGH_WATER
+            if overloaded:
+                app.intake_stats['shed'] += 1
+            with app.tasks.timed("intake"):
+                await notify_admins(app, submission_id, digest=overloaded)
+        except Exception as e:
+            logging.error(f"Ошибка рассылки заявки {submission_id}: {e}")
+        finally:
+            app.intake.task_done()
+
+def start_intake_workers(app: BotApp) -> list:
+    return [app.tasks.service("intake", partial(intake_worker, app)) for _ in range(INTAKE_WORKERS)]
+
+def percentile(values, fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+# ---------------- СВОДКА ЗАЯВОК ----------------
+def queue_for_digest(app: BotApp, submission_id: int):
+    """Ставит заявку в сводку и запускает таймер окна, если он ещё не идёт"""
+    app.digest_queue.append(submission_id)
+    if app.digest_timer is None:
+        app.digest_timer = app.tasks.call_later("digest", DIGEST_WINDOW, partial(flush_digest, app))
+
+def digest_line(user_msg: dict) -> str:
+    """Одна строка сводки: номер, автор, тип и начало текста"""
+    if user_msg.get('type') == 'media_group':
+        kind = f"альбом ({len(user_msg['messages'])})"
+    else:
+        kind = getattr(user_msg['content_type'], 'value', user_msg['content_type'])
+    
+    line = f"📝 {hbold('#' + str(user_msg['post_id']))} · 🆔 {user_msg['user_id_counter']} · 📎 {kind}"
+    
+    snippet = (user_msg.get('text') or user_msg.get('caption') or '').replace("\n", " ")
+    if snippet:
+        if len(snippet) > 80:
+            snippet = snippet[:80] + "…"
+        line += f"\n   {hitalic(snippet)}"
+    return line
+
+async def flush_digest(app: BotApp):
+    """Отправляет накопленные заявки админам одним сообщением на пачку"""
+    if app.digest_timer:
+        app.digest_timer.cancel()
+    app.digest_timer = None
+    
+    # Уже обработанные (или вычищенные) заявки в сводку не попадают
+    items = [app.user_messages[uid] for uid in app.digest_queue if uid in app.user_messages]
+    app.digest_queue.clear()
+    if not items:
         return
     
-    user_msg = user_messages.get(unique_id)
-    if not user_msg:
+    for start in range(0, len(items), DIGEST_MAX_ITEMS):
+        chunk = items[start:start + DIGEST_MAX_ITEMS]
+        record = {
+            'items': [(item['submission_id'], item['post_id']) for item in chunk],
+            'resolved': {}
+        }
+        text = (
+            f"📬 {hbold('СВОДКА ЗАЯВОК')} ({len(chunk)})\n"
+            "━━━━━━━━━━━━━━\n" +
+            "\n".join(digest_line(item) for item in chunk) +
+            "\n━━━━━━━━━━━━━━\n"
+            "👁 - показать заявку целиком"
+        )
+        for admin in app.admins:
+            try:
+                digest_msg = await app.bot.send_message(
+                    admin,
+                    text,
+                    reply_markup=digest_keyboard(record),
+                    parse_mode="HTML"
+                )
+            except Exception as e:
+                logging.error(f"Ошибка отправки сводки админу {admin}: {e}")
+                continue
+            app.digest_messages[(admin, digest_msg.message_id)] = {
+                'items': list(record['items']),
+                'resolved': {}
+            }
+            for item in chunk:
+                item.setdefault('admin_messages', []).append((admin, digest_msg.message_id))
+
+async def view_submission(cb: types.CallbackQuery, callback_data: ModerationCallback, app: BotApp):
+    """Показ полной заявки из сводки по запросу"""
+    submission_id = callback_data.submission_id
+    if submission_id not in app.user_messages:
         await cb.answer("❌ Сообщение не найдено")
         return
     
     try:
-        post_group_id = str(uuid.uuid4())
-        channel_message_ids = []
-        
-        # ПУБЛИКАЦИЯ АЛЬБОМА
-        if user_msg.get('type') == 'media_group':
-            messages = user_msg['messages']
-            messages.sort(key=lambda x: x.date)
-            
-            media_group = []
-            video_notes = []
-            
-            # Разделяем кружочки и остальные медиа
-            for msg in messages:
-                if msg.video_note:
-                    video_notes.append(msg)
-                elif msg.photo or msg.video:
-                    if msg.photo:
-                        file_id = msg.photo[-1].file_id
-                        if not media_group:
-                            caption = msg.caption or ""
-                            caption += f"\n\n{FOOTER_TEXT}"
-                            media_group.append(
-                                InputMediaPhoto(
-                                    media=file_id,
-                                    caption=caption,
-                                    parse_mode="HTML"
-                                )
-                            )
-                        else:
-                            media_group.append(
-                                InputMediaPhoto(
-                                    media=file_id
-                                )
-                            )
-                    elif msg.video:
-                        file_id = msg.video.file_id
-                        if not media_group:
-                            caption = msg.caption or ""
-                            caption += f"\n\n{FOOTER_TEXT}"
-                            media_group.append(
-                                InputMediaVideo(
-                                    media=file_id,
-                                    caption=caption,
-                                    parse_mode="HTML"
-                                )
-                            )
-                        else:
-                            media_group.append(
-                                InputMediaVideo(
-                                    media=file_id
-                                )
-                            )
-            
-            # Отправляем кружочки
-            for vn in video_notes:
-                vn_msg = await bot.send_video_note(
-                    chat_id=CHANNEL_ID,
-                    video_note=vn.video_note.file_id
-                )
-                channel_message_ids.append(vn_msg.message_id)
-            
-            # Отправляем медиа-группу
-            if media_group:
-                channel_msgs = await bot.send_media_group(CHANNEL_ID, media_group)
-                channel_message_ids.extend([msg.message_id for msg in channel_msgs])
-            
-            # Сохраняем информацию о посте
-            if channel_message_ids:
-                channel_posts[post_group_id] = {
-                    'message_ids': channel_message_ids,
-                    'user_counter': user_id_counter,
-                    'post_id': post_id,
-                    'unique_id': unique_id
-                }
-            
-            await cb.message.answer(
-                f"✅ {hbold('Альбом опубликован!')}\n\n"
-                f"📝 Номер поста: {hcode(str(post_id))}\n"
-                f"🆔 ID пользователя: {hcode(str(user_id_counter))}\n"
-                f"🖼 Медиа в посте: {len(channel_message_ids)}",
-                reply_markup=published_keyboard(post_group_id),
-                parse_mode="HTML"
-            )
+        await send_submission_card(app, cb.from_user.id, submission_id)
+        await cb.answer()
+    except Exception as e:
+        logging.error(f"Ошибка показа заявки: {e}")
+        await cb.answer("❌ Ошибка при показе")
+
+async def close_moderation_message(app: BotApp, cb: types.CallbackQuery, submission_id: int):
+    """Убирает заявку из сообщения, где нажали кнопку: карточку удаляет, из сводки убирает строку"""
+    if not cb.message:
+        return
+    await drop_admin_copy(app, cb.message.chat.id, cb.message.message_id, submission_id)
+
+async def drop_admin_copy(app: BotApp, chat_id: int, message_id: int, submission_id: int):
+    key = (chat_id, message_id)
+    record = app.digest_messages.get(key)
+    try:
+        if record is None:
+            await app.bot.delete_message(chat_id, message_id)
+            return
         
-        # ПУБЛИКАЦИЯ ОДИНОЧНОГО СООБЩЕНИЯ
+        record['items'] = [item for item in record['items'] if item[0] != submission_id]
+        record['resolved'].pop(submission_id, None)
+        if record['items']:
+            await app.bot.edit_message_reply_markup(chat_id=chat_id, message_id=message_id, reply_markup=digest_keyboard(record))
         else:
-            footer = f"\n\n{FOOTER_TEXT}"
-            
-            if user_msg['content_type'] == 'video_note':
-                channel_msg = await bot.send_video_note(
-                    chat_id=CHANNEL_ID,
-                    video_note=user_msg['media']
+            del app.digest_messages[key]
+            await app.bot.delete_message(chat_id, message_id)
+    except Exception as e:
+        logging.error(f"Ошибка обновления сообщения модерации: {e}")
+
+async def mark_admin_copy(app: BotApp, chat_id: int, message_id: int, submission_id: int, label: str):
+    """Копия заявки у другого админа: вместо кнопок - кто и что сделал"""
+    record = app.digest_messages.get((chat_id, message_id))
+    try:
+        if record is None:
+            markup = taken_keyboard(submission_id, label)
+        else:
+            record['resolved'][submission_id] = label
+            markup = digest_keyboard(record)
+            if all(item[0] in record['resolved'] for item in record['items']):
+                del app.digest_messages[(chat_id, message_id)]
+        await app.bot.edit_message_reply_markup(chat_id=chat_id, message_id=message_id, reply_markup=markup)
+    except Exception as e:
+        logging.error(f"Ошибка обновления копии заявки у {chat_id}: {e}")
+
+async def taken_submission(cb: types.CallbackQuery):
+    await cb.answer("Заявка уже обработана")
+
+# ---------------- ЗАХВАТ ЗАЯВОК МОДЕРАТОРАМИ ----------------
+
+def claim_submission(app: BotApp, submission_id: int, admin_id: int, name: str, lease: float = CLAIM_LEASE):
+    """Compare-and-set: берёт заявку, если она свободна, её аренда истекла или она уже наша.
+    Возвращает None при успехе, иначе чужой захват"""
+    now = time.monotonic()
+    claim = app.submission_claims.get(submission_id)
+    if claim and claim['admin'] != admin_id and claim['until'] > now:
+        return claim
+    app.submission_claims[submission_id] = {'admin': admin_id, 'name': name, 'until': now + lease}
+    return None
+
+@asynccontextmanager
+async def claimed_submission(app: BotApp, cb: types.CallbackQuery, submission_id: int):
+    """Одно действие над заявкой за раз: второй модератор (или повторное нажатие)
+    получает ответ, кто уже занят заявкой. Отдаёт True, если заявка наша"""
+    lock = app.submission_locks.get(submission_id)
+    claim = app.submission_claims.get(submission_id)
+    if lock and lock.locked():
+        await cb.answer(f"⏳ Заявку уже обрабатывает {claim['name'] if claim else 'другой модератор'}")
+        yield False
+        return
+    
+    claim = claim_submission(app, submission_id, cb.from_user.id, cb.from_user.full_name)
+    if claim:
+        await cb.answer(f"⏳ Заявку взял {claim['name']}")
+        yield False
+        return
+    
+    lock = app.submission_locks.setdefault(submission_id, asyncio.Lock())
+    async with lock:
+        try:
+            yield True
+        finally:
+            app.submission_locks.pop(submission_id, None)
+            # Заявка обработана - захват больше не нужен; при ошибке держится до конца аренды
+            if submission_id not in app.user_messages:
+                app.submission_claims.pop(submission_id, None)
+
+async def resolve_admin_copies(app: BotApp, cb: types.CallbackQuery, user_msg: dict, label: str):
+    """После действия: у себя заявка убирается, у остальных админов - показывается, кто её взял.
+    Все сообщения правятся параллельно"""
+    own = (cb.message.chat.id, cb.message.message_id) if cb.message else None
+    label = f"{label} · {cb.from_user.full_name}"
+    
+    tasks = []
+    for chat_id, message_id in user_msg.get('admin_messages', []):
+        if (chat_id, message_id) == own:
+            continue
+        tasks.append(mark_admin_copy(app, chat_id, message_id, user_msg['submission_id'], label))
+    if own:
+        tasks.append(drop_admin_copy(app, own[0], own[1], user_msg['submission_id']))
+    
+    await asyncio.gather(*tasks)
+
+# ---------------- ОЧЕРЕДЬ /next ----------------
+def push_pending(app: BotApp, submission_id: int):
+    """Ставит заявку в кучу для /next. Приоритет - время прихода, альбомы и
+    доверенные авторы получают фору и идут раньше"""
+    user_msg = app.user_messages.get(submission_id)
+    if not user_msg:
+        return
+    priority = user_msg.get('received', time.time())
+    if user_msg.get('type') == 'media_group':
+        priority -= PULL_ALBUM_BOOST
+    if user_msg['telegram_id'] in app.trusted:
+        priority -= PULL_TRUSTED_BOOST
+    heapq.heappush(app.pull_heap, (priority, submission_id))
+
+def rebuild_pull_heap(app: BotApp):
+    """Куча ведётся только в режиме /next; при его включении (и для /next вне режима)
+    собирается заново из ожидающих заявок"""
+    app.pull_heap = []
+    for submission_id in list(app.user_messages):
+        push_pending(app, submission_id)
+
+def prune_pull_heap(app: BotApp) -> list:
+    """Выбрасывает из кучи обработанные и вычищенные заявки"""
+    live = [entry for entry in app.pull_heap if entry[1] in app.user_messages]
+    if len(live) < len(app.pull_heap):
+        heapq.heapify(live)
+        app.pull_heap = live
+    return live
+
+def is_free(app: BotApp, submission_id: int, now: float) -> bool:
+    """Заявка ещё не обработана и не закреплена за модератором"""
+    claim = app.submission_claims.get(submission_id)
+    return submission_id in app.user_messages and not (claim and claim['until'] > now)
+
+def take_next(app: BotApp, admin_id: int, name: str):
+    """Самая приоритетная свободная заявка, сразу закреплённая за модератором.
+    Выданная заявка остаётся в куче: если модератор не успеет за PULL_LEASE,
+    её получит следующий /next"""
+    if not is_pull_mode(app):
+        rebuild_pull_heap(app)
+    now = time.monotonic()
+    kept = []
+    taken = None
+    while app.pull_heap:
+        entry = heapq.heappop(app.pull_heap)
+        if entry[1] not in app.user_messages:
+            continue  # уже обработана или вычищена
+        kept.append(entry)
+        if is_free(app, entry[1], now):
+            claim_submission(app, entry[1], admin_id, name, PULL_LEASE)
+            taken = entry[1]
+            break
+    for entry in kept:
+        heapq.heappush(app.pull_heap, entry)
+    return taken
+
+def pull_waiting(app: BotApp) -> int:
+    """Сколько заявок ждёт /next; заодно выбрасывает из кучи обработанные"""
+    if not is_pull_mode(app):
+        rebuild_pull_heap(app)
+    live = prune_pull_heap(app)
+    now = time.monotonic()
+    return sum(1 for _, submission_id in live if is_free(app, submission_id, now))
+
+def schedule_pull_counter(app: BotApp):
+    """Счётчик очереди у админов обновляется не чаще раза в PULL_COUNTER_INTERVAL,
+    сколько бы заявок ни пришло"""
+    if app.pull_counter_timer is None:
+        app.pull_counter_timer = app.tasks.call_later("pull-counter", PULL_COUNTER_INTERVAL, partial(update_pull_counters, app))
+
+async def update_pull_counters(app: BotApp):
+    """Одно сообщение со счётчиком на админа: правится на месте, новое - только если старого нет"""
+    app.pull_counter_timer = None
+    text = f"📥 Ждут модерации: {hbold(pull_waiting(app))}\n/next - взять следующую заявку"
+    
+    for admin in app.admins:
+        message_id = app.pull_counters.get(admin)
+        if message_id:
+            try:
+                await app.bot.edit_message_text(text, chat_id=admin, message_id=message_id, parse_mode="HTML")
+                continue
+            except TelegramBadRequest as e:
+                if "not modified" in str(e):
+                    continue
+            except Exception as e:
+                logging.error(f"Ошибка обновления счётчика у {admin}: {e}")
+                continue
+        try:
+            counter_msg = await app.bot.send_message(admin, text, parse_mode="HTML")
+            app.pull_counters[admin] = counter_msg.message_id
+        except Exception as e:
+            logging.error(f"Ошибка отправки счётчика админу {admin}: {e}")
+
+async def next_submission(message: types.Message, app: BotApp):
+    if message.from_user.id not in app.admins:
+        return
+    
+    submission_id = take_next(app, message.from_user.id, message.from_user.full_name)
+    if submission_id is None:
+        await message.answer("📭 Свободных заявок нет")
+        return
+    
+    try:
+        await send_submission_card(app, message.from_user.id, submission_id)
+    except Exception as e:
+        # Заявка не дошла - отдаём её следующему
+        app.submission_claims.pop(submission_id, None)
+        logging.error(f"Ошибка выдачи заявки {submission_id}: {e}")
+        await message.answer(f"❌ Ошибка: {str(e)[:100]}")
+        return
+    
+    await message.answer(f"📥 Ждут модерации ещё: {hbold(pull_waiting(app))} · /next - следующая", parse_mode="HTML")
+    if is_pull_mode(app):
+        schedule_pull_counter(app)
+
+async def toggle_pull(message: types.Message, app: BotApp):
+    if message.from_user.id not in app.admins:
+        return
+    
+    new_mode = not is_pull_mode(app)
+    set_pull_mode(app, new_mode)
+    if new_mode:
+        rebuild_pull_heap(app)
+    else:
+        # Ждавшие /next заявки уходят админам одной сводкой
+        now = time.monotonic()
+        for _, submission_id in sorted(app.pull_heap):
+            if is_free(app, submission_id, now):
+                queue_for_digest(app, submission_id)
+        app.pull_heap = []
+        await flush_digest(app)
+    await message.answer(
+        f"📥 {hbold('Режим очереди /next')}\n"
+        f"{'✅ ВКЛЮЧЕН' if new_mode else '❌ ВЫКЛЮЧЕН'}\n"
+        + ("Заявки не рассылаются, модераторы берут их по одной командой /next"
+           if new_mode else "Заявки снова рассылаются админам"),
+        parse_mode="HTML"
+    )
+
+# ---------------- ОБРАБОТКА ВСЕХ ТИПОВ СООБЩЕНИЙ ----------------
+async def user_message(message: types.Message, app: BotApp):
+    """Обработчик одиночных сообщений от пользователей"""
+    
+    if message.media_group_id:
+        return
+    
+    telegram_id = message.from_user.id
+    
+    if telegram_id in app.admins and not is_admin_accepting(app):
+        return
+    
+    if message.text and message.text.startswith('/'):
+        return
+    
+    user_id_counter = get_user_id_counter(app, telegram_id)
+    post_id = get_next_post_id(app)
+    submission_id = get_next_submission_id(app)
+    
+    user = message.from_user
+    username = f"@{user.username}" if user.username else "❌ Нет username"
+    full_name = user.full_name or "Не указано"
+    
+    app.user_messages[submission_id] = {
+        'chat_id': message.chat.id,
+        'message_id': message.message_id,
+        'content_type': message.content_type,
+        'text': message.text or message.caption or '',
+        'caption': message.caption or '',
+        'user_id_counter': user_id_counter,
+        'post_id': post_id,
+        'telegram_id': telegram_id,
+        'submission_id': submission_id,
+        'username': username,
+        'full_name': full_name,
+        'received': time.time()
+    }
+    
+    if message.photo:
+        app.user_messages[submission_id]['media'] = message.photo[-1].file_id
+    elif message.video:
+        app.user_messages[submission_id]['media'] = message.video.file_id
+    elif message.video_note:
+        app.user_messages[submission_id]['media'] = message.video_note.file_id
+    elif message.document:
+        app.user_messages[submission_id]['media'] = message.document.file_id
+    elif message.voice:
+        app.user_messages[submission_id]['media'] = message.voice.file_id
+    elif message.audio:
+        app.user_messages[submission_id]['media'] = message.audio.file_id
+    elif message.animation:
+        app.user_messages[submission_id]['media'] = message.animation.file_id
+    
+    app.event_log.record(
+        'submit', post_id,
+        user_id_counter=user_id_counter,
+        telegram_id=telegram_id,
+        content_type=app.user_messages[submission_id]['content_type'],
+        text=app.user_messages[submission_id]['text'][:200]
+    )
+    app.search_index.add(post_id, app.user_messages[submission_id]['text'], 'pending')
+    
+    enqueue_submission(app, submission_id)
+    
+    await message.reply(f"✅ Ваше сообщение №{post_id} отправлено на модерацию!")
+
+# ---------------- ПУБЛИКАЦИЯ С ПОДДЕРЖКОЙ АЛЬБОМОВ ----------------
+PUBLISHABLE_TYPES = ('text', 'photo', 'video', 'video_note', 'document', 'voice', 'audio', 'animation')
+
+def build_publication(user_msg: dict, admin: int) -> dict:
+    """Всё, что нужно для публикации, в виде, который можно сохранить на диск"""
+    publication = {
+        'submission_id': user_msg['submission_id'],
+        'post_id': user_msg['post_id'],
+        'user_id_counter': user_msg['user_id_counter'],
+        'telegram_id': user_msg['telegram_id'],
+        'admin': admin
+    }
+    
+    if user_msg.get('type') == 'media_group':
+        items = []
+        for msg in sorted(user_msg['messages'], key=lambda x: x.date):
+            if msg.video_note:
+                items.append({'type': 'video_note', 'file_id': msg.video_note.file_id})
+            elif msg.photo:
+                items.append({'type': 'photo', 'file_id': msg.photo[-1].file_id, 'caption': msg.caption or ''})
+            elif msg.video:
+                items.append({'type': 'video', 'file_id': msg.video.file_id, 'caption': msg.caption or ''})
+        publication['type'] = 'media_group'
+        publication['items'] = items
+    else:
+        publication['type'] = 'message'
+        publication['content_type'] = getattr(user_msg['content_type'], 'value', user_msg['content_type'])
+        publication['text'] = user_msg['text']
+        publication['caption'] = user_msg['caption']
+        publication['media'] = user_msg.get('media')
+    
+    return publication
+
+async def publish_to_channel(app: BotApp, publication: dict) -> list:
+    """Отправляет публикацию в канал, возвращает ID сообщений в канале"""
+    channel_message_ids = []
+    footer = f"\n\n{app.config.footer}" if app.config.footer else ""
+    
+    # ПУБЛИКАЦИЯ АЛЬБОМА
+    if publication['type'] == 'media_group':
+        media_group = []
+        
+        for item in publication['items']:
+            # Кружочки отправляются отдельно от остальных медиа
+            if item['type'] == 'video_note':
+                vn_msg = await app.bot.send_video_note(
+                    chat_id=app.channel_id,
+                    video_note=item['file_id']
                 )
-                channel_message_ids.append(channel_msg.message_id)
-                
-                if user_msg['caption']:
-                    caption_msg = await bot.send_message(
-                        CHANNEL_ID,
-                        user_msg['caption'] + footer,
+                channel_message_ids.append(vn_msg.message_id)
+                continue
+            
+            media_class = InputMediaPhoto if item['type'] == 'photo' else InputMediaVideo
+            if not media_group:
+                media_group.append(
+                    media_class(
+                        media=item['file_id'],
+                        caption=item['caption'] + footer,
                         parse_mode="HTML"
                     )
-                    channel_message_ids.append(caption_msg.message_id)
+                )
             else:
-                if user_msg['content_type'] == 'text':
-                    channel_msg = await bot.send_message(
-                        CHANNEL_ID,
-                        user_msg['text'] + footer,
-                        parse_mode="HTML",
-                        disable_web_page_preview=True
-                    )
-                elif user_msg['content_type'] == 'photo':
-                    caption = user_msg['caption'] or ""
-                    caption += footer
-                    channel_msg = await bot.send_photo(
-                        chat_id=CHANNEL_ID,
-                        photo=user_msg['media'],
-                        caption=caption,
-                        parse_mode="HTML"
+                media_group.append(
+                    media_class(
+                        media=item['file_id']
                     )
-                elif user_msg['content_type'] == 'video':
-                    caption = user_msg['caption'] or ""
-                    caption += footer
-                    channel_msg = await bot.send_video(
-                        chat_id=CHANNEL_ID,
-                        video=user_msg['media'],
-                        caption=caption,
-                        parse_mode="HTML"
-                    )
-                elif user_msg['content_type'] == 'document':
-                    caption = user_msg['caption'] or ""
-                    caption += footer
-                    channel_msg = await bot.send_document(
-                        chat_id=CHANNEL_ID,
-                        document=user_msg['media'],
-                        caption=caption,
-                        parse_mode="HTML"
-                    )
-                elif user_msg['content_type'] == 'voice':
-                    caption = user_msg['caption'] or ""
-                    caption += footer
-                    channel_msg = await bot.send_voice(
-                        chat_id=CHANNEL_ID,
-                        voice=user_msg['media'],
-                        caption=caption,
-                        parse_mode="HTML"
-                    )
-                elif user_msg['content_type'] == 'audio':
-                    caption = user_msg['caption'] or ""
-                    caption += footer
-                    channel_msg = await bot.send_audio(
-                        chat_id=CHANNEL_ID,
-                        audio=user_msg['media'],
-                        caption=caption,
-                        parse_mode="HTML"
-                    )
-                elif user_msg['content_type'] == 'animation':
-                    caption = user_msg['caption'] or ""
-                    caption += footer
-                    channel_msg = await bot.send_animation(
-                        chat_id=CHANNEL_ID,
-                        animation=user_msg['media'],
-                        caption=caption,
-                        parse_mode="HTML"
-                    )
-                else:
-                    await cb.answer("❌ Неподдерживаемый тип")
-                    return
-                
-                channel_message_ids.append(channel_msg.message_id)
-            
-            if channel_message_ids:
-                channel_posts[post_group_id] = {
-                    'message_ids': channel_message_ids,
-                    'user_counter': user_id_counter,
-                    'post_id': post_id,
-                    'unique_id': unique_id
-                }
-            
-            await cb.message.answer(
-                f"✅ {hbold('Пост опубликован!')}\n\n"
-                f"📝 Номер поста: {hcode(str(post_id))}\n"
-                f"🆔 ID пользователя: {hcode(str(user_id_counter))}",
-                reply_markup=published_keyboard(post_group_id),
-                parse_mode="HTML"
-            )
+                )
+        
+        if media_group:
+            channel_msgs = await app.bot.send_media_group(app.channel_id, media_group)
+            channel_message_ids.extend([msg.message_id for msg in channel_msgs])
         
-        if unique_id in user_messages:
-            del user_messages[unique_id]
+        return channel_message_ids
+    
+    # ПУБЛИКАЦИЯ ОДИНОЧНОГО СООБЩЕНИЯ
+    content_type = publication['content_type']
+    caption = (publication['caption'] or "") + footer
+    
+    if content_type == 'video_note':
+        channel_msg = await app.bot.send_video_note(
+            chat_id=app.channel_id,
+            video_note=publication['media']
+        )
+        channel_message_ids.append(channel_msg.message_id)
         
+        if publication['caption']:
+            caption_msg = await app.bot.send_message(
+                app.channel_id,
+                caption,
+                parse_mode="HTML"
+            )
+            channel_message_ids.append(caption_msg.message_id)
+        return channel_message_ids
+    
+    if content_type == 'text':
+        channel_msg = await app.bot.send_message(
+            app.channel_id,
+            publication['text'] + footer,
+            parse_mode="HTML",
+            disable_web_page_preview=True
+        )
+    elif content_type == 'photo':
+        channel_msg = await app.bot.send_photo(
+            chat_id=app.channel_id,
+            photo=publication['media'],
+            caption=caption,
+            parse_mode="HTML"
+        )
+    elif content_type == 'video':
+        channel_msg = await app.bot.send_video(
+            chat_id=app.channel_id,
+            video=publication['media'],
+            caption=caption,
+            parse_mode="HTML"
+        )
+    elif content_type == 'document':
+        channel_msg = await app.bot.send_document(
+            chat_id=app.channel_id,
+            document=publication['media'],
+            caption=caption,
+            parse_mode="HTML"
+        )
+    elif content_type == 'voice':
+        channel_msg = await app.bot.send_voice(
+            chat_id=app.channel_id,
+            voice=publication['media'],
+            caption=caption,
+            parse_mode="HTML"
+        )
+    elif content_type == 'audio':
+        channel_msg = await app.bot.send_audio(
+            chat_id=app.channel_id,
+            audio=publication['media'],
+            caption=caption,
+            parse_mode="HTML"
+        )
+    elif content_type == 'animation':
+        channel_msg = await app.bot.send_animation(
+            chat_id=app.channel_id,
+            animation=publication['media'],
+            caption=caption,
+            parse_mode="HTML"
+        )
+    
+    channel_message_ids.append(channel_msg.message_id)
+    return channel_message_ids
+
+async def finish_publication(app: BotApp, publication: dict, channel_message_ids: list):
+    """После публикации: запоминаем пост, сообщаем админу и автору"""
+    submission_id = publication['submission_id']
+    post_id = publication['post_id']
+    user_id_counter = publication['user_id_counter']
+    
+    # Сохраняем информацию о посте: по ней работает кнопка удаления
+    if channel_message_ids:
+        app.post_archive.add(submission_id, post_id, user_id_counter, channel_message_ids)
+    
+    app.event_log.record('approve', post_id, admin=publication['admin'], message_ids=channel_message_ids)
+    app.search_index.set_status(post_id, 'published')
+    
+    if publication['type'] == 'media_group':
+        text = (
+            f"✅ {hbold('Альбом опубликован!')}\n\n"
+            f"📝 Номер поста: {hcode(str(post_id))}\n"
+            f"🆔 ID пользователя: {hcode(str(user_id_counter))}\n"
+            f"🖼 Медиа в посте: {len(channel_message_ids)}"
+        )
+    else:
+        text = (
+            f"✅ {hbold('Пост опубликован!')}\n\n"
+            f"📝 Номер поста: {hcode(str(post_id))}\n"
+            f"🆔 ID пользователя: {hcode(str(user_id_counter))}"
+        )
+    
+    try:
+        await app.bot.send_message(
+            publication['admin'],
+            text,
+            reply_markup=published_keyboard(submission_id),
+            parse_mode="HTML"
+        )
+    except Exception as e:
+        logging.error(f"Ошибка уведомления админа о публикации: {e}")
+    
+    if is_reachable(app, publication['telegram_id']):
         try:
-            await bot.send_message(
-                telegram_id,
+            await app.bot.send_message(
+                publication['telegram_id'],
                 f"✅ {hbold('Ваше сообщение №' + str(post_id) + ' опубликовано в канале!')}",
                 parse_mode="HTML"
             )
         except:
             pass
+
+def take_publication(app: BotApp, cb: types.CallbackQuery, submission_id: int):
+    """Забирает заявку из ожидающих и готовит публикацию; None - если публиковать нечего"""
+    user_msg = app.user_messages.get(submission_id)
+    if not user_msg:
+        return None, "❌ Сообщение не найдено"
+    
+    publication = build_publication(user_msg, cb.message.chat.id if cb.message else cb.from_user.id)
+    if publication['type'] == 'message' and publication['content_type'] not in PUBLISHABLE_TYPES:
+        return None, "❌ Неподдерживаемый тип"
+    
+    return publication, None
+
+async def approve(cb: types.CallbackQuery, callback_data: ModerationCallback, app: BotApp):
+    submission_id = callback_data.submission_id
+    async with claimed_submission(app, cb, submission_id) as ok:
+        if not ok:
+            return
         
-        await cb.answer("✅ Опубликовано!")
-        await cb.message.delete()
+        if app.post_archive.get(submission_id):
+            await cb.answer("✅ Уже опубликовано")
+            return
         
-    except Exception as e:
-        logging.error(f"Ошибка публикации: {e}")
-        await cb.answer(f"❌ Ошибка: {str(e)[:50]}...")
+        publication, error = take_publication(app, cb, submission_id)
+        if error:
+            await cb.answer(error)
+            return
+        
+        try:
+            channel_message_ids = await publish_to_channel(app, publication)
+            
+            user_msg = app.user_messages.pop(submission_id, {})
+            
+            await finish_publication(app, publication, channel_message_ids)
+            
+            await cb.answer("✅ Опубликовано!")
+            await resolve_admin_copies(app, cb, user_msg, "✅ Опубликовал")
+        
+        except Exception as e:
+            logging.error(f"Ошибка публикации: {e}")
+            await cb.answer(f"❌ Ошибка: {str(e)[:50]}...")
 
-# ---------------- ОТКЛОНЕНИЕ ----------------
-@dp.callback_query(F.data.startswith("decline"))
-async def decline(cb: types.CallbackQuery):
+# ---------------- ОТЛОЖЕННАЯ ПУБЛИКАЦИЯ ----------------
+def load_schedule(app: BotApp):
+    if not os.path.exists(app.schedule_file):
+        return [], 0
     try:
-        data = cb.data.split(":")
-        if len(data) < 4:
-            await cb.answer("❌ Ошибка в данных")
+        with open(app.schedule_file, "r") as f:
+            data = json.load(f)
+        heap = [tuple(entry) for entry in data.get('queue', [])]
+        heapq.heapify(heap)
+        return heap, data.get('last_slot', 0)
+    except Exception as e:
+        logging.error(f"Ошибка загрузки расписания: {e}")
+        return [], 0
+
+def save_schedule(app: BotApp):
+    snapshot = {'queue': list(app.schedule_heap), 'last_slot': app.last_slot}
+    state_writer.write(app.schedule_file, lambda: json.dumps(snapshot, ensure_ascii=False))
+
+def in_quiet_hours(ts: float) -> bool:
+    hour = datetime.fromtimestamp(ts, SCHEDULE_TZ).hour
+    if QUIET_HOURS_START <= QUIET_HOURS_END:
+        return QUIET_HOURS_START <= hour < QUIET_HOURS_END
+    return hour >= QUIET_HOURS_START or hour < QUIET_HOURS_END
+
+def next_slot(app: BotApp) -> float:
+    """Ближайший свободный слот: не раньше чем через SLOT_SPACING после
+    предыдущего и не в тихие часы"""
+    return after_quiet_hours(max(time.time(), app.last_slot + SLOT_SPACING))
+
+def after_quiet_hours(slot: float) -> float:
+    if in_quiet_hours(slot):
+        moment = datetime.fromtimestamp(slot, SCHEDULE_TZ)
+        moment = moment.replace(hour=QUIET_HOURS_END, minute=0, second=0, microsecond=0)
+        if moment.timestamp() < slot:
+            moment += timedelta(days=1)
+        slot = moment.timestamp()
+    return slot
+
+def format_slot(ts: float) -> str:
+    return datetime.fromtimestamp(ts, SCHEDULE_TZ).strftime("%d.%m %H:%M")
+
+def schedule_publication(app: BotApp, publication: dict) -> float:
+    due = next_slot(app)
+    app.last_slot = due
+    heapq.heappush(app.schedule_heap, (due, publication['submission_id'], publication))
+    save_schedule(app)
+    app.schedule_wakeup.set()
+    return due
+
+async def approve_scheduled(cb: types.CallbackQuery, callback_data: ModerationCallback, app: BotApp):
+    submission_id = callback_data.submission_id
+    async with claimed_submission(app, cb, submission_id) as ok:
+        if not ok:
             return
+        
+        publication, error = take_publication(app, cb, submission_id)
+        if error:
+            await cb.answer(error)
+            return
+        
+        due = schedule_publication(app, publication)
+        user_msg = app.user_messages.pop(submission_id)
+        app.event_log.record('schedule', publication['post_id'], admin=cb.from_user.id, due=int(due))
+        app.search_index.set_status(publication['post_id'], 'scheduled')
+        
+        await cb.answer(f"🕒 Пост №{publication['post_id']} выйдет {format_slot(due)}")
+        await resolve_admin_copies(app, cb, user_msg, f"🕒 {format_slot(due)}")
+
+async def run_scheduler(app: BotApp):
+    """Одна задача спит до ближайшей публикации из кучи"""
+    while True:
+        app.schedule_wakeup.clear()
+        if not app.schedule_heap:
+            await app.schedule_wakeup.wait()
+            continue
+        
+        delay = app.schedule_heap[0][0] - time.time()
+        if delay > 0:
+            try:
+                await asyncio.wait_for(app.schedule_wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        
+        # Запись уходит из кучи только после публикации: при ошибке или падении
+        # процесса пост остаётся в расписании на диске
+        entry = app.schedule_heap[0]
+        due, submission_id, publication = entry
+        try:
+            # Уже в архиве - значит опубликован, но процесс упал до удаления из расписания
+            if not app.post_archive.get(submission_id):
+                channel_message_ids = await publish_to_channel(app, publication)
+                await finish_publication(app, publication, channel_message_ids)
+        except (TelegramBadRequest, TelegramForbiddenError) as e:
+            # Ответ Telegram не изменится от повтора: текст не разбирается, бота убрали из канала
+            await drop_scheduled(app, entry, str(e))
+            continue
+        except Exception as e:
+            attempts = publication.get('attempts', 0) + 1
+            logging.error(f"Ошибка отложенной публикации поста {publication['post_id']} (попытка {attempts}): {e}")
+            if attempts >= SCHEDULE_MAX_ATTEMPTS:
+                await drop_scheduled(app, entry, f"{attempts} попыток, последняя ошибка: {e}")
+                continue
             
-        user_id_counter = int(data[1])
-        post_id = int(data[2])
-        unique_id = data[3]
-    except (IndexError, ValueError):
-        await cb.answer("❌ Ошибка в данных")
+            publication['attempts'] = attempts
+            retry = after_quiet_hours(max(due, time.time()) + SLOT_SPACING)
+            reschedule(app, entry, retry)
+            # Админу - только о первой ошибке, о снятии поста скажет drop_scheduled
+            if attempts == 1:
+                try:
+                    await app.bot.send_message(
+                        publication['admin'],
+                        f"❌ Не удалось опубликовать пост №{publication['post_id']} по расписанию: {e}\n"
+                        f"Следующая попытка {format_slot(retry)}, всего попыток {SCHEDULE_MAX_ATTEMPTS}"
+                    )
+                except:
+                    pass
+            continue
+        
+        reschedule(app, entry, None)
+        app.last_slot = max(app.last_slot, time.time())
+        save_schedule(app)
+
+async def drop_scheduled(app: BotApp, entry: tuple, reason: str):
+    """Снимает пост с расписания насовсем: запись в журнал и одно сообщение админу"""
+    publication = entry[2]
+    reschedule(app, entry, None)
+    save_schedule(app)
+    app.event_log.record('unschedule', publication['post_id'], admin=publication['admin'], error=reason[:200])
+    app.search_index.remove(publication['post_id'])
+    logging.error(f"Пост {publication['post_id']} снят с расписания: {reason}")
+    try:
+        await app.bot.send_message(
+            publication['admin'],
+            f"❌ Пост №{publication['post_id']} снят с расписания и не будет опубликован: {reason}"
+        )
+    except:
+        pass
+
+def reschedule(app: BotApp, entry: tuple, due: float):
+    """Убирает запись из кучи (пока шла публикация, вершина могла смениться)
+    и ставит снова на время due, если оно задано"""
+    try:
+        app.schedule_heap.remove(entry)
+        heapq.heapify(app.schedule_heap)
+    except ValueError:
+        pass
+    if due is not None:
+        heapq.heappush(app.schedule_heap, (due, entry[1], entry[2]))
+        save_schedule(app)
+
+# ---------------- ОТКЛОНЕНИЕ ----------------
+async def decline(cb: types.CallbackQuery, callback_data: ModerationCallback, app: BotApp):
+    submission_id = callback_data.submission_id
+    async with claimed_submission(app, cb, submission_id) as ok:
+        if ok:
+            await decline_claimed(app, cb, submission_id)
+
+async def decline_claimed(app: BotApp, cb: types.CallbackQuery, submission_id: int):
+    user_msg = app.user_messages.pop(submission_id, None)
+    if not user_msg:
+        await cb.answer("❌ Сообщение не найдено")
+        await close_moderation_message(app, cb, submission_id)
         return
     
-    telegram_id = get_telegram_id_by_counter(user_id_counter)
-    if telegram_id:
+    post_id = user_msg['post_id']
+    app.event_log.record('decline', post_id, admin=cb.from_user.id)
+    app.search_index.remove(post_id)
+    
+    if is_reachable(app, user_msg['telegram_id']):
         try:
-            await bot.send_message(
-                telegram_id,
+            await app.bot.send_message(
+                user_msg['telegram_id'],
                 f"❌ {hbold('Ваше сообщение №' + str(post_id) + ' отклонено модератором')}",
                 parse_mode="HTML"
             )
         except:
             pass
     
-    if unique_id in user_messages:
-        del user_messages[unique_id]
-    
     await cb.answer("❌ Отклонено")
-    await cb.message.delete()
+    await resolve_admin_copies(app, cb, user_msg, "❌ Отклонил")
 
 # ---------------- УДАЛЕНИЕ ВСЕГО ПОСТА ----------------
-@dp.callback_query(F.data.startswith("delete"))
-async def delete_post(cb: types.CallbackQuery):
+async def delete_post(cb: types.CallbackQuery, callback_data: ModerationCallback, app: BotApp):
     """Удаление всего поста из канала"""
     try:
-        parts = cb.data.split(":")
-        if len(parts) < 2:
-            await cb.answer("❌ Ошибка в данных")
-            return
-        
-        post_group_id = parts[1]
+        submission_id = callback_data.submission_id
         
-        if post_group_id not in channel_posts:
+        post_data = app.post_archive.get(submission_id)
+        if not post_data:
             await cb.answer("❌ Пост не найден")
             return
-        
-        post_data = channel_posts[post_group_id]
-        message_ids = post_data.get('message_ids', [])
+        if post_data['deleted']:
+            await cb.answer("❌ Пост уже удалён")
+            return
+        message_ids = post_data['message_ids']
         
         deleted_count = 0
         for msg_id in message_ids:
             try:
-                await bot.delete_message(CHANNEL_ID, msg_id)
+                await app.bot.delete_message(app.channel_id, msg_id)
                 deleted_count += 1
                 await asyncio.sleep(0.1)
             except Exception as e:
                 logging.error(f"Ошибка удаления сообщения {msg_id}: {e}")
         
-        del channel_posts[post_group_id]
+        app.post_archive.mark_deleted(submission_id)
+        app.search_index.remove(post_data['post_id'])
+        app.event_log.record('delete', post_data['post_id'], admin=cb.from_user.id, deleted=deleted_count)
         
         await cb.answer(f"🗑 Удалено {deleted_count} сообщений")
         
@@ -1085,61 +3267,945 @@ async def delete_post(cb: types.CallbackQuery):
                 )
             except:
                 pass
-                
+    
     except Exception as e:
         logging.error(f"Ошибка удаления: {e}")
         await cb.answer("❌ Ошибка при удалении")
 
+# ---------------- КНОПКИ СТАРОГО ФОРМАТА ----------------
+async def legacy_callback(cb: types.CallbackQuery):
+    await cb.answer("❌ Кнопка устарела")
+
 # ---------------- ПЕРИОДИЧЕСКАЯ ОЧИСТКА СТАРЫХ СООБЩЕНИЙ ----------------
-async def cleanup_old_messages():
+async def cleanup_old_messages(app: BotApp):
     """Очистка старых сообщений из хранилища"""
     while True:
         await asyncio.sleep(24 * 60 * 60)
         
-        if len(user_messages) > 100:
-            keys_to_remove = list(user_messages.keys())[:-100]
+        # Вычищаются только заявки, которые админы уже видели. В режиме /next остальные
+        # ждут в очереди, и самые старые из них - первые на выдачу
+        if len(app.user_messages) > 100:
+            keys_to_remove = [key for key in list(app.user_messages.keys())[:-100]
+                              if app.user_messages[key].get('admin_messages')]
             for key in keys_to_remove:
-                del user_messages[key]
+                app.search_index.remove(app.user_messages.pop(key)['post_id'])
+        prune_pull_heap(app)
+        
+        for key in [key for key, record in app.digest_messages.items()
+                    if not any(item[0] in app.user_messages for item in record['items'])]:
+            del app.digest_messages[key]
         
-        logging.info(f"Очистка хранилища: {len(user_messages)} сообщений, {len(channel_posts)} постов")
+        logging.info(f"Очистка хранилища: {len(app.user_messages)} сообщений, {len(app.post_archive)} постов в архиве")
 
-# ---------------- ЗАПУСК ----------------
-async def main():
+# ---------------- ЗАПИСЬ ТРАФИКА ----------------
+class TraceRecorder(BaseMiddleware):
+    """Запись входящих обновлений для проигрывания (включается TRACE_DIR).
+    
+    ID пользователей заменяются псевдонимами (HMAC со случайным ключом на каждый
+    запуск - обратно не восстановить, но один человек остаётся одним в пределах
+    записи), имена и username стираются, текст не-команд - заглушкой той же длины
+    (TRACE_KEEP_TEXT=1 - оставить). Сегменты gzip JSONL по TRACE_SEGMENT_UPDATES
+    обновлений пишет отдельный поток; при переполнении очереди обновления теряются,
+    а не задерживают бота.
+    """
+    
+    def __init__(self, directory: str, keep_text: bool = False):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.keep_text = keep_text
+        self.recorded = 0
+        self.dropped = 0
+        self._key = os.urandom(16)
+        self._bots = {}  # ID бота -> админы (псевдонимы) и канал, пишутся в начало каждого сегмента
+        self._segment_bots = set()  # чьи записи уже есть в текущем сегменте
+        self._queue = queue.Queue(maxsize=TRACE_QUEUE_SIZE)
+        self._thread = threading.Thread(target=self._run, name="trace-recorder", daemon=True)
+        self._thread.start()
+    
+    def pseudonym(self, user_id: int) -> int:
+        digest = hmac.new(self._key, str(user_id).encode(), hashlib.sha256).digest()
+        return TRACE_PSEUDONYM_BASE + int.from_bytes(digest[:5], "big")
+    
+    async def __call__(self, handler, event, data):
+        bot = data['bot']
+        if bot.id not in self._bots:
+            app = data['app']
+            self._bots[bot.id] = {
+                'admins': [self.pseudonym(admin) for admin in app.admins],
+                'channel_id': app.channel_id
+            }
+            self._put({'type': 'bot', 'bot': bot.id, **self._bots[bot.id]})
+        # В JSON здесь, обезличивание и сжатие - в потоке записи
+        self._put({'type': 'update', 't': time.time(), 'bot': bot.id,
+                   'update': event.model_dump(mode="json", exclude_none=True, by_alias=True)})
+        return await handler(event, data)
+    
+    def _put(self, record: dict):
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+    
+    def _scrub(self, node):
+        if isinstance(node, list):
+            for item in node:
+                self._scrub(item)
+            return
+        if not isinstance(node, dict):
+            return
+        
+        # User и Chat: у пользователей и личных чатов ID положительные, у групп и каналов - нет
+        if isinstance(node.get('id'), int) and ('is_bot' in node or 'type' in node):
+            if node['id'] > 0 and not node.get('is_bot'):
+                node['id'] = self.pseudonym(node['id'])
+                for key in ('first_name', 'last_name'):
+                    if key in node:
+                        node[key] = "U"
+                node.pop('username', None)
+        node.pop('phone_number', None)
+        if not self.keep_text:
+            for key in ('text', 'caption'):
+                value = node.get(key)
+                if isinstance(value, str) and not value.startswith('/'):
+                    # Длина в UTF-16 та же - смещения entities остаются верными
+                    node[key] = "x" * (len(value.encode("utf-16-le")) // 2)
+        for value in node.values():
+            self._scrub(value)
+    
+    def _open_segment(self, number: int):
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+        segment = gzip.open(os.path.join(self.directory, f"trace-{stamp}-{number:04d}.jsonl.gz"), "wt", encoding="utf-8")
+        segment.write(json.dumps({'type': 'meta', 'version': TRACE_VERSION, 'started': time.time()}) + "\n")
+        self._segment_bots = set()
+        for bot_id, meta in list(self._bots.items()):
+            segment.write(json.dumps({'type': 'bot', 'bot': bot_id, **meta}) + "\n")
+            self._segment_bots.add(bot_id)
+        return segment
+    
+    def _run(self):
+        segment = None
+        number = in_segment = 0
+        while True:
+            record = self._queue.get()
+            try:
+                if record is None:
+                    if segment:
+                        segment.close()
+                    return
+                if segment is None or in_segment >= TRACE_SEGMENT_UPDATES:
+                    if segment:
+                        segment.close()
+                    number += 1
+                    in_segment = 0
+                    segment = self._open_segment(number)
+                if record['type'] == 'update':
+                    self._scrub(record['update'])
+                    in_segment += 1
+                    self.recorded += 1
+                elif record['bot'] in self._segment_bots:
+                    continue  # уже в начале сегмента
+                else:
+                    self._segment_bots.add(record['bot'])
+                segment.write(json.dumps(record, ensure_ascii=False) + "\n")
+            except Exception as e:
+                logging.error(f"Ошибка записи трассы: {e}")
+            finally:
+                self._queue.task_done()
+    
+    def close(self):
+        """Дописывает очередь и закрывает сегмент: без этого хвост gzip будет оборван"""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(10)
+
+# ---------------- СБОРКА ПРИЛОЖЕНИЯ ----------------
+MESSAGE_TYPES = F.text | F.photo | F.video | F.video_note | F.document | F.voice | F.audio | F.animation
+
+def create_router() -> Router:
+    """Все обработчики бота. Порядок важен: команды и альбомы регистрируются раньше
+    общего обработчика сообщений, который забирает любой текст"""
+    router = Router()
+    
+    commands = [
+        ("start", start),
+        ("help", help_cmd),
+        ("reply", admin_reply),
+        ("test_user", test_user),
+        ("stats", stats),
+        ("api_stats", api_stats),
+        ("lag", loop_status),
+        ("tasks", task_status),
+        ("debug_mem", debug_mem),
+        ("schedule", show_schedule),
+        ("post", post_history),
+        ("user_posts", user_posts),
+        ("search", search),
+        ("check_ids", check_ids),
+        ("list_users", list_users),
+        ("myid", my_id),
+        ("toggle_accept", toggle_accept),
+        ("toggle_digest", toggle_digest),
+        ("toggle_pull", toggle_pull),
+        ("next", next_submission),
+        ("intake", intake_status),
+        ("broadcast", broadcast)
+    ]
+    for command, handler in commands:
+        router.message.register(handler, Command(command))
+    
+    # Ответ админа на карточку заявки уходит автору, а не становится новой заявкой
+    router.message.register(quote_reply, ~F.media_group_id, MESSAGE_TYPES, quoted_submission)
+    router.message.register(handle_media_group, F.media_group_id)
+    router.message.register(user_message, MESSAGE_TYPES)
+    
+    router.callback_query.register(approve, ModerationCallback.filter(F.action == Action.approve))
+    router.callback_query.register(approve_scheduled, ModerationCallback.filter(F.action == Action.schedule))
+    router.callback_query.register(decline, ModerationCallback.filter(F.action == Action.decline))
+    router.callback_query.register(delete_post, ModerationCallback.filter(F.action == Action.delete))
+    router.callback_query.register(view_submission, ModerationCallback.filter(F.action == Action.view))
+    router.callback_query.register(taken_submission, ModerationCallback.filter(F.action == Action.taken))
+    router.callback_query.register(search_page, SearchCallback.filter())
+    router.callback_query.register(legacy_callback, F.data.regexp(r"^(approve|decline|delete|view):"))
+    
+    return router
+
+def load_app_state(app: BotApp):
+    """Данные бота с диска: пользователи, доступность, расписание, журнал"""
+    app.user_id_map = load_user_id_map(app)
+    check_duplicate_ids(app)
+    app.reachability = load_reachability(app)
+    app.schedule_heap, app.last_slot = load_schedule(app)
+    app.event_log = EventLog(app.events_dir)
+    app.post_archive = PostArchive(app.archive_dir)
+
+class AppMiddleware(BaseMiddleware):
+    """Подставляет в обработчики BotApp того бота, которому пришло обновление"""
+    
+    def __init__(self, apps: dict):
+        self.apps = apps
+    
+    async def __call__(self, handler, event, data):
+        app = self.apps.get(data['bot'].id)
+        if app is None:
+            return None
+        data['app'] = app
+        return await handler(event, data)
+
+def open_app(config: BotConfig) -> BotApp:
+    """Блокировка и данные с диска одного бота"""
+    app = BotApp(config)
+    os.makedirs(app.data_dir, exist_ok=True)
+    
+    app.lock_file = acquire_lock(app.lock_path)
+    if not app.lock_file:
+        raise AlreadyRunningError(app.lock_path)
+    
     try:
-        if not os.path.exists(ADMIN_MODE_FILE):
-            set_admin_accepting(True)
+        load_app_state(app)
+    except Exception:
+        release_lock(app.lock_file, app.lock_path)
+        raise
+    return app
+
+def create_apps(configs: list, session=None, recorder: TraceRecorder = None) -> list:
+    """Собирает ботов одного процесса: у каждого свои канал, админы и данные,
+    а Dispatcher, обработчики и HTTP-сессия общие. Импорт модуля ничего из этого не делает.
+    session - своя сессия Bot API (например, поддельная для тестов),
+    recorder - запись входящих обновлений"""
+    apps = {}  # ID бота -> BotApp
+    session = session or create_session(apps, len(configs))
+    
+    dp = Dispatcher()
+    dp.update.outer_middleware(AppMiddleware(apps))
+    if recorder:
+        dp.update.outer_middleware(recorder)
+    dp.include_router(create_router())
+    
+    try:
+        for config in configs:
+            started = time.perf_counter()
+            try:
+                bot = Bot(token=config.token, session=session)
+            except TokenValidationError:
+                raise ConfigError(f"Неверный токен бота для канала {config.channel_id}")
+            if bot.id in apps:
+                raise ConfigError(f"Бот {bot.id} указан дважды")
+            
+            app = open_app(config)
+            app.bot = bot
+            app.dp = dp
+            app.trace_recorder = recorder
+            apps[bot.id] = app
+            app.startup_time = time.perf_counter() - started
+    except Exception:
+        for app in apps.values():
+            close_app(app)
+        raise
+    
+    return list(apps.values())
+
+def create_app(config: BotConfig = None, session=None) -> BotApp:
+    """Один бот, настройки по умолчанию из окружения"""
+    return create_apps([config or BotConfig.from_env()], session)[0]
+
+def close_app(app: BotApp):
+    """Дописывает отложенные файлы и освобождает блокировку"""
+    state_writer.flush(10)
+    if app.event_log:
+        app.event_log.flush()
+    if app.post_archive:
+        app.post_archive.flush()
+    if app.trace_recorder:
+        app.trace_recorder.close()
+    release_lock(app.lock_file, app.lock_path)
+    app.lock_file = None
+
+# ---------------- ПРОИГРЫВАНИЕ ЗАПИСИ ----------------
+def trace_files(path: str) -> list:
+    """Сегменты записи: один файл или все trace-*.jsonl.gz папки по порядку"""
+    if os.path.isdir(path):
+        return sorted(os.path.join(path, name) for name in os.listdir(path)
+                      if name.startswith("trace-") and name.endswith(".jsonl.gz"))
+    return [path]
+
+def read_trace(path: str):
+    for file_path in trace_files(path):
+        try:
+            with gzip.open(file_path, "rt", encoding="utf-8") as f:
+                for line in f:
+                    yield json.loads(line)
+        except EOFError:
+            # Сегмент, который пишется сейчас или не был закрыт: читается всё, что успело
+            logging.warning(f"{file_path}: сегмент не закрыт, прочитано до обрыва")
+
+class FakeBotSession(BaseSession):
+    """Bot API без сети для проигрывания: после задержки latency отвечает
+    правдоподобными объектами и считает вызовы по методам"""
+    
+    def __init__(self, latency: float = 0.0):
+        super().__init__()
+        self.latency = latency
+        self.calls = {}  # метод -> число вызовов
+        self._message_id = 0
+    
+    async def close(self):
+        pass
+    
+    async def stream_content(self, *args, **kwargs):
+        yield b""
+    
+    def _message(self, bot, chat_id):
+        self._message_id += 1
+        chat_id = chat_id if isinstance(chat_id, int) else 0
+        chat = types.Chat(id=chat_id, type="private" if chat_id > 0 else "channel")
+        return types.Message(message_id=self._message_id, date=datetime.now(), chat=chat).as_(bot)
+    
+    async def make_request(self, bot, method, timeout=None):
+        name = type(method).__name__
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
         
-        for admin in ADMINS:
-            if admin not in user_id_map:
-                get_user_id_counter(admin)
+        if name == "GetMe":
+            return types.User(id=bot.id, is_bot=True, first_name="replay")
+        if name == "SendMediaGroup":
+            return [self._message(bot, method.chat_id) for _ in method.media]
+        if name == "CopyMessage":
+            self._message_id += 1
+            return types.MessageId(message_id=self._message_id)
+        if name.startswith("Send"):
+            return self._message(bot, method.chat_id)
+        return True
+
+class HandlerTimer(BaseMiddleware):
+    """Время каждого обработчика по имени функции. Через TaskSupervisor.timer
+    замеряет и фоновую работу: рассылку админам (intake), альбомы, сводку"""
+    
+    def __init__(self):
+        self.latencies = {}  # обработчик -> сек. на каждый вызов
+        self.errors = {}
+    
+    async def __call__(self, handler, event, data):
+        name = data['handler'].callback.__name__ if 'handler' in data else type(event).__name__
+        with self.measure(name):
+            return await handler(event, data)
+    
+    @contextmanager
+    def measure(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.errors[name] = self.errors.get(name, 0) + 1
+            raise
+        finally:
+            self.latencies.setdefault(name, []).append(time.perf_counter() - started)
+
+async def replay_trace(path: str, speed: float, data_dir: str, api_latency: float = 0.0) -> dict:
+    """Проигрывает запись через Dispatcher с поддельным Bot API, сохраняя промежутки
+    между обновлениями, ускоренные в speed раз (0 - без пауз). Данные ботов - в data_dir"""
+    bots = {}
+    for record in read_trace(path):
+        if record['type'] == 'bot':
+            bots[record['bot']] = record
+        elif record['type'] == 'update':
+            bots.setdefault(record['bot'], {'admins': [], 'channel_id': None})
+    if not bots:
+        raise ConfigError(f"{path}: в записи нет обновлений")
+    
+    session = FakeBotSession(api_latency)
+    apps = create_apps([
+        BotConfig(f"{bot_id}:replay", meta['admins'], meta['channel_id'], os.path.join(data_dir, f"bot{bot_id}"))
+        for bot_id, meta in bots.items()
+    ], session)
+    by_id = {app.bot.id: app for app in apps}
+    timer = HandlerTimer()
+    apps[0].dp.message.middleware(timer)
+    apps[0].dp.callback_query.middleware(timer)
+    for app in apps:
+        app.tasks.timer = timer
+        app.tasks.service("scheduler", partial(run_scheduler, app))
+        start_intake_workers(app)
+    loop_watchdog.start()
+    
+    in_flight = asyncio.Semaphore(REPLAY_CONCURRENCY)
+    
+    async def feed(app: BotApp, update: types.Update):
+        try:
+            await app.dp.feed_update(app.bot, update)
+        finally:
+            in_flight.release()
+    
+    fed = 0
+    behind = 0.0  # сек., на сколько проигрывание отстало от записи
+    first = None
+    started = time.monotonic()
+    try:
+        for record in read_trace(path):
+            if record['type'] != 'update':
+                continue
+            if first is None:
+                first = record['t']
+            if speed:
+                delay = (record['t'] - first) / speed - (time.monotonic() - started)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                else:
+                    behind = max(behind, -delay)
+            
+            await in_flight.acquire()
+            app = by_id[record['bot']]
+            app.tasks.spawn("replay", partial(feed, app, types.Update.model_validate(record['update'], context={"bot": app.bot})))
+            fed += 1
         
-        asyncio.create_task(cleanup_old_messages())
+        # Ждём обработчики, затем досылаем то, что shutdown() отменил бы: альбомы
+        # (ждут секунду после последнего фото), очередь рассылки и окно сводки
+        for _ in range(REPLAY_CONCURRENCY):
+            await in_flight.acquire()
+        for app in apps:
+            await app.tasks.run_pending("album")
+            await app.intake.join()
+            await app.tasks.run_pending("digest", "pull-counter")
+        elapsed = time.monotonic() - started
+    finally:
+        loop_watchdog.stop()
+        for app in apps:
+            await app.tasks.shutdown()
+            close_app(app)
+    
+    return {
+        'updates': fed,
+        'elapsed': elapsed,
+        'behind': behind,
+        'handlers': {name: (len(values), percentile(values, 0.5), percentile(values, 0.95), max(values), timer.errors.get(name, 0))
+                     for name, values in timer.latencies.items()},
+        'api_calls': dict(session.calls),
+        'loop_lag': (percentile(loop_watchdog.lags, 0.5), percentile(loop_watchdog.lags, 0.95), loop_watchdog.max_lag)
+    }
+
+def format_replay_report(report: dict, speed: float) -> str:
+    lines = [
+        f"Обновлений: {report['updates']} за {report['elapsed']:.1f} сек. "
+        f"({report['updates'] / max(report['elapsed'], 1e-9):.0f}/сек.), "
+        f"скорость: {'без пауз' if not speed else f'×{speed:g}'}"
+        + (f", отставание до {report['behind']:.2f} сек." if report['behind'] > 0.01 else ""),
+        "",
+        "Обработчик | вызовов | p50 мс | p95 мс | макс мс | ошибок"
+    ]
+    for name, (count, p50, p95, worst, errors) in sorted(report['handlers'].items(), key=lambda x: -x[1][0]):
+        lines.append(f"{name}: {count} | {p50 * 1000:.1f} | {p95 * 1000:.1f} | {worst * 1000:.1f} | {errors}")
+    lines.append("")
+    lines.append(f"Bot API: {sum(report['api_calls'].values())} вызовов")
+    for name, count in sorted(report['api_calls'].items(), key=lambda x: -x[1]):
+        lines.append(f"{name}: {count}")
+    p50, p95, worst = report['loop_lag']
+    lines.append("")
+    lines.append(f"Задержка event loop: p50 {p50 * 1000:.1f} · p95 {p95 * 1000:.1f} · макс {worst * 1000:.0f} мс")
+    return "\n".join(lines)
+
+# ---------------- ЭКСПОРТ, ИМПОРТ И ПРОВЕРКА ДАННЫХ ----------------
+SNAPSHOT_VERSION = 1
+IMPORT_BATCH = 10_000  # записей на одну пачку при импорте
+
+# Имя в снимке -> атрибут BotApp с путём файла
+STATE_FILES = {
+    'post_number': 'post_counter_file',
+    'reply_counter': 'reply_counter_file',
+    'submission_counter': 'submission_counter_file',
+    'admin_mode': 'admin_mode_file',
+    'digest_mode': 'digest_mode_file',
+    'pull_mode': 'pull_mode_file'
+}
+STATE_COUNTERS = ('post_number', 'reply_counter', 'submission_counter')
+
+def offline_app(data_dir: str) -> BotApp:
+    """BotApp только ради путей к файлам: без токена, блокировки и чтения данных"""
+    return BotApp(BotConfig(None, data_dir=data_dir))
+
+def read_file(path: str):
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return f.read().strip()
+
+def open_snapshot(path: str, mode: str):
+    """Файл снимка: '-' - stdin/stdout, .gz - со сжатием"""
+    if path == "-":
+        return nullcontext(sys.stdin if mode == "r" else sys.stdout)
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+def iter_user_map(app: BotApp):
+    """Пары (Telegram ID, внутренний ID) из файла по одной строке"""
+    if not os.path.exists(app.user_id_file):
+        return
+    with open(app.user_id_file, "r") as f:
+        for line in f:
+            parts = line.strip().split(":")
+            if len(parts) != 2:
+                continue
+            try:
+                yield int(parts[0]), int(parts[1])
+            except ValueError:
+                continue
+
+@contextmanager
+def reachability_reader(app: BotApp):
+    """Статус доступности по внутреннему ID без загрузки файла в память"""
+    if not os.path.exists(app.reachability_file) or not os.path.getsize(app.reachability_file):
+        yield lambda user_counter: REACHABLE
+        return
+    with open(app.reachability_file, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        yield lambda user_counter: mm[user_counter] if user_counter < len(mm) else REACHABLE
+
+def iter_event_lines(directory: str):
+    """(сегмент, смещение, строка) журнала до конца, каким он был в начале чтения.
+    Недописанная последняя строка пропускается"""
+    segments = list_segments(directory)
+    ends = {segment: os.path.getsize(segment_path(directory, segment)) for segment in segments}
+    for segment in segments:
+        with open(segment_path(directory, segment), "rb") as f:
+            offset = 0
+            while offset < ends[segment]:
+                line = f.readline()
+                if not line.endswith(b"\n") or offset + len(line) > ends[segment]:
+                    break
+                yield segment, offset, line
+                offset += len(line)
+
+def export_records(app: BotApp):
+    """Снимок состояния записями по одной: файлы читаются построчно, память не растёт
+    с числом пользователей. Бот может работать - все файлы заменяются атомарно,
+    а журнал читается до конца, зафиксированного в начале"""
+    yield {'type': 'meta', 'version': SNAPSHOT_VERSION, 'exported_at': int(time.time())}
+    
+    for name, attr in STATE_FILES.items():
+        value = read_file(getattr(app, attr))
+        if value is not None:
+            yield {'type': 'state', 'name': name, 'value': value}
+    
+    with reachability_reader(app) as status_of:
+        for telegram_id, user_counter in iter_user_map(app):
+            yield {'type': 'user', 'telegram_id': telegram_id, 'user_id': user_counter, 'reachability': status_of(user_counter)}
+    
+    if os.path.isdir(app.archive_dir):
+        for post in PostArchive(app.archive_dir):
+            post.pop('slot')
+            yield {'type': 'published', **post}
+    
+    heap, last_slot = load_schedule(app)
+    yield {'type': 'schedule', 'last_slot': last_slot}
+    for due, submission_id, publication in sorted(heap, key=lambda entry: entry[:2]):
+        yield {'type': 'scheduled', 'due': due, 'submission_id': submission_id, 'publication': publication}
+    
+    for _, _, line in iter_event_lines(app.events_dir):
+        event = json.loads(line)
+        # Ссылки на предыдущие события при импорте строятся заново
+        event.pop('prev', None)
+        event.pop('prev_user', None)
+        yield {'type': 'event', 'event': event}
+
+def write_statuses(f, statuses: dict):
+    """Пачка статусов доступности прямо на свои места в файле"""
+    for user_counter, status in sorted(statuses.items()):
+        f.seek(user_counter)
+        f.write(bytes([status]))
+    statuses.clear()
+
+def import_snapshot(data_dir: str, records, force: bool = False) -> dict:
+    """Раскладывает снимок по файлам папки data_dir пачками по IMPORT_BATCH.
+    Папка блокируется, как при запуске бота; данные в ней должны отсутствовать (или force)"""
+    app = offline_app(data_dir)
+    os.makedirs(data_dir, exist_ok=True)
+    lock_file = acquire_lock(app.lock_path)
+    if not lock_file:
+        raise AlreadyRunningError(app.lock_path)
+    
+    try:
+        if not force and (os.path.exists(app.user_id_file) or list_segments(app.events_dir)):
+            raise ConfigError(f"В {data_dir} уже есть данные, импорт - только в пустую папку")
         
+        if force:
+            # Всё прежнее состояние уходит: оставшееся расписание или режим из старых
+            # данных сработали бы поверх нового снимка
+            for directory in (app.events_dir, app.archive_dir):
+                if os.path.isdir(directory):
+                    shutil.rmtree(directory)
+            for path in [getattr(app, attr) for attr in STATE_FILES.values()] + [app.schedule_file]:
+                if os.path.exists(path):
+                    os.unlink(path)
+        event_log = EventLog(app.events_dir)
+        archive = PostArchive(app.archive_dir)
+        counts = {}
+        users, statuses, events = [], {}, []
+        schedule = {'queue': [], 'last_slot': 0}
+        
+        with open(app.user_id_file + ".tmp", "w") as users_file, open(app.reachability_file, "wb") as status_file:
+            for record in records:
+                kind = record.get('type')
+                counts[kind] = counts.get(kind, 0) + 1
+                
+                if kind == 'meta' and record.get('version') != SNAPSHOT_VERSION:
+                    raise ConfigError(f"Неизвестная версия снимка: {record.get('version')}")
+                elif kind == 'state' and record['name'] in STATE_FILES:
+                    StateWriter._write_atomic(getattr(app, STATE_FILES[record['name']]), str(record['value']))
+                elif kind == 'user':
+                    users.append(f"{record['telegram_id']}:{record['user_id']}\n")
+                    if record.get('reachability'):
+                        statuses[record['user_id']] = record['reachability']
+                    if len(users) >= IMPORT_BATCH:
+                        users_file.write("".join(users))
+                        users.clear()
+                        write_statuses(status_file, statuses)
+                elif kind == 'published':
+                    archive.add(record['submission_id'], record['post_id'], record['user_counter'],
+                                record['message_ids'], record['published_at'], record['deleted'])
+                elif kind == 'schedule':
+                    schedule['last_slot'] = record['last_slot']
+                elif kind == 'scheduled':
+                    schedule['queue'].append([record['due'], record['submission_id'], record['publication']])
+                elif kind == 'event':
+                    events.append(record['event'])
+                    if len(events) >= IMPORT_BATCH:
+                        event_log.append_many(events)
+                        events.clear()
+            
+            users_file.write("".join(users))
+            write_statuses(status_file, statuses)
+            users_file.flush()
+            os.fsync(users_file.fileno())
+        
+        event_log.append_many(events)
+        event_log.flush()
+        archive.flush()
+        os.replace(app.user_id_file + ".tmp", app.user_id_file)
+        if schedule['queue'] or schedule['last_slot']:
+            StateWriter._write_atomic(app.schedule_file, json.dumps(schedule, ensure_ascii=False))
+        return counts
+    finally:
+        release_lock(lock_file, app.lock_path)
+
+def store_size(data_dir: str) -> int:
+    total = 0
+    for root, _, files in os.walk(data_dir):
+        total += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+    return total
+
+def compact_store(data_dir: str, out_dir: str = None):
+    """Переупаковка: снимок заново раскладывается по файлам - журнал без оборванных
+    строк, индексы и файл доступности без лишнего хвоста. В out_dir можно писать
+    и при работающем боте, на месте - только при остановленном.
+    Возвращает размер данных до и после"""
+    src = offline_app(data_dir)
+    if out_dir:
+        import_snapshot(out_dir, export_records(src))
+        return store_size(data_dir), store_size(out_dir)
+    
+    lock_file = acquire_lock(src.lock_path)
+    if not lock_file:
+        raise AlreadyRunningError(src.lock_path)
+    try:
+        before = store_size(data_dir)
+        tmp_dir = os.path.join(data_dir, f".compact-{os.getpid()}")
+        import_snapshot(tmp_dir, export_records(src))
+        
+        for attr in list(STATE_FILES.values()) + ['user_id_file', 'reachability_file', 'schedule_file']:
+            new_path = os.path.join(tmp_dir, os.path.basename(getattr(src, attr)))
+            if os.path.exists(new_path):
+                os.replace(new_path, getattr(src, attr))
+        for directory in (src.events_dir, src.archive_dir):
+            old_dir = directory + ".old"
+            if os.path.isdir(directory):
+                os.replace(directory, old_dir)
+            os.replace(os.path.join(tmp_dir, os.path.basename(directory)), directory)
+            if os.path.isdir(old_dir):
+                shutil.rmtree(old_dir)
+        shutil.rmtree(tmp_dir)
+        return before, store_size(data_dir)
+    finally:
+        release_lock(lock_file, src.lock_path)
+
+def verify_index(app: BotApp, name: str, field: str, problems: list) -> int:
+    """Каждая запись индекса должна указывать на событие с тем же номером"""
+    path = os.path.join(app.events_dir, name)
+    if not os.path.exists(path):
+        return 0
+    checked = 0
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for number in range(len(mm) // INDEX_RECORD.size):
+            segment, offset = INDEX_RECORD.unpack_from(mm, number * INDEX_RECORD.size)
+            if not segment:
+                continue
+            checked += 1
+            try:
+                with open(segment_path(app.events_dir, segment), "rb") as events:
+                    events.seek(offset)
+                    event = json.loads(events.readline())
+                if event.get(field) != number:
+                    problems.append(f"{name}: №{number} указывает на событие с {field}={event.get(field)}")
+            except (OSError, ValueError) as e:
+                problems.append(f"{name}: №{number} -> сегмент {segment}, смещение {offset}: {e}")
+            if len(problems) > 100:
+                break
+    return checked
+
+def verify_store(app: BotApp):
+    """Проверка целостности файлов без загрузки их в память. Возвращает (проблемы, сводку)"""
+    problems = []
+    info = {}
+    
+    for name, attr in STATE_FILES.items():
+        value = read_file(getattr(app, attr))
+        if value is None:
+            continue
+        if name in STATE_COUNTERS and not value.isdigit():
+            problems.append(f"{name}: не число ({value!r})")
+        elif name not in STATE_COUNTERS and value not in ("on", "off"):
+            problems.append(f"{name}: ожидается on/off ({value!r})")
+    
+    # Внутренние ID плотные, так что битовая карта занимает бит на пользователя
+    seen = bytearray()
+    users = bad_lines = duplicates = 0
+    if os.path.exists(app.user_id_file):
+        with open(app.user_id_file, "r") as f:
+            for line in f:
+                parts = line.strip().split(":")
+                try:
+                    user_counter = int(parts[1]) if len(parts) == 2 and int(parts[0]) else -1
+                except ValueError:
+                    user_counter = -1
+                if user_counter < 1:
+                    bad_lines += 1
+                    continue
+                users += 1
+                if user_counter // 8 >= len(seen):
+                    seen.extend(bytes(user_counter // 8 + 1 - len(seen)))
+                if seen[user_counter // 8] & (1 << user_counter % 8):
+                    duplicates += 1
+                seen[user_counter // 8] |= 1 << user_counter % 8
+    info['пользователей'] = users
+    if bad_lines:
+        problems.append(f"user_id_map: битых строк {bad_lines}")
+    if duplicates:
+        problems.append(f"user_id_map: повторов внутреннего ID {duplicates} (исправит /check_ids)")
+    
+    if os.path.exists(app.reachability_file):
+        invalid = 0
+        with open(app.reachability_file, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 16), b""):
+                invalid += sum(1 for status in chunk if status > CHAT_NOT_FOUND)
+        if invalid:
+            problems.append(f"user_reachability: неизвестных статусов {invalid}")
+    
+    if os.path.exists(app.schedule_file):
+        try:
+            with open(app.schedule_file, "r") as f:
+                info['в расписании'] = len(json.load(f).get('queue', []))
+        except ValueError as e:
+            problems.append(f"schedule.json: {e}")
+    
+    events = broken = 0
+    for segment, offset, line in iter_event_lines(app.events_dir):
+        try:
+            json.loads(line)
+            events += 1
+        except ValueError:
+            broken += 1
+            if broken <= 10:
+                problems.append(f"журнал: сегмент {segment}, смещение {offset} - битая строка")
+    info['событий'] = events
+    info['сегментов'] = len(list_segments(app.events_dir))
+    info['постов в индексе'] = verify_index(app, "post_index.bin", 'post_id', problems)
+    info['авторов в индексе'] = verify_index(app, "user_index.bin", 'user_id_counter', problems)
+    
+    if os.path.isdir(app.archive_dir):
+        archive = PostArchive(app.archive_dir)
+        for post in archive:
+            if archive.get(post['submission_id']) is None or archive.by_post(post['post_id']) is None:
+                problems.append(f"архив: запись {post['slot']} (пост #{post['post_id']}) не найти по индексу")
+                if len(problems) > 100:
+                    break
+        info['постов в архиве'] = len(archive)
+    
+    return problems, info
+
+def run_cli(argv: list) -> int:
+    """Команды обслуживания данных; без команды bot.py запускает бота"""
+    parser = argparse.ArgumentParser(prog="bot.py", description="Обслуживание данных бота")
+    parser.add_argument("--data-dir", default=os.environ.get("DATA_DIR") or DEFAULT_DATA_DIR,
+                        help="папка с данными бота")
+    commands = parser.add_subparsers(dest="command", required=True)
+    
+    export_cmd = commands.add_parser("export", help="снимок состояния в JSONL (.gz - со сжатием)")
+    export_cmd.add_argument("file", nargs="?", default="-", help="файл снимка, по умолчанию stdout")
+    import_cmd = commands.add_parser("import", help="загрузка снимка в пустую папку")
+    import_cmd.add_argument("file", help="файл снимка, - для stdin")
+    import_cmd.add_argument("--force", action="store_true", help="перезаписать данные в папке")
+    compact_cmd = commands.add_parser("compact", help="переупаковка хранилищ")
+    compact_cmd.add_argument("--out", help="писать в другую папку (можно при работающем боте)")
+    commands.add_parser("verify", help="проверка целостности")
+    replay_cmd = commands.add_parser("replay", help="проигрывание записи TRACE_DIR с поддельным Bot API")
+    replay_cmd.add_argument("trace", help="сегмент .jsonl.gz или папка записи")
+    replay_cmd.add_argument("--speed", type=float, default=1, help="ускорение: 1, 10, ...; 0 - без пауз")
+    replay_cmd.add_argument("--into", help="папка для данных ботов (по умолчанию временная)")
+    replay_cmd.add_argument("--api-latency", type=float, default=0.0, help="сек. на каждый вызов Bot API")
+    
+    args = parser.parse_args(argv)
+    try:
+        if args.command == "export":
+            count = 0
+            with open_snapshot(args.file, "w") as f:
+                for record in export_records(offline_app(args.data_dir)):
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                    count += 1
+            print(f"✅ Выгружено записей: {count}", file=sys.stderr)
+        
+        elif args.command == "import":
+            with open_snapshot(args.file, "r") as f:
+                counts = import_snapshot(args.data_dir, (json.loads(line) for line in f if line.strip()), args.force)
+            print("✅ Загружено: " + ", ".join(f"{kind} {count}" for kind, count in counts.items()))
+        
+        elif args.command == "compact":
+            before, after = compact_store(args.data_dir, args.out)
+            print(f"✅ Переупаковано: {before / 1024:.0f} КБ -> {after / 1024:.0f} КБ")
+        
+        elif args.command == "verify":
+            problems, info = verify_store(offline_app(args.data_dir))
+            print(" · ".join(f"{name}: {value}" for name, value in info.items()))
+            for problem in problems:
+                print(f"❌ {problem}")
+            if problems:
+                return 1
+            print("✅ Ошибок не найдено")
+        
+        elif args.command == "replay":
+            # Никогда не в --data-dir: проигрывание меняет данные как настоящий трафик
+            into = args.into or tempfile.mkdtemp(prefix="replay-")
+            report = asyncio.run(replay_trace(args.trace, args.speed, into, args.api_latency))
+            print(format_replay_report(report, args.speed))
+            print(f"\n📁 Данные проигрывания: {into}")
+    
+    except AlreadyRunningError as e:
+        print(f"❌ ОШИБКА: папка занята работающим ботом ({e.lock_path})", file=sys.stderr)
+        return 1
+    except (ConfigError, OSError, ValueError) as e:
+        print(f"❌ ОШИБКА: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+# ---------------- ЗАПУСК ----------------
+async def main(apps: list):
+    try:
         print("\n" + "="*50)
-        print("🤖 БОТ ЗАПУЩЕН!")
-        print("="*50)
-        print(f"👤 Админы: {ADMINS}")
-        print(f"📢 Канал: {CHANNEL_ID}")
-        print(f"👥 Пользователей: {len(user_id_map)}")
-        print(f"📁 Данные: {DATA_DIR}")
-        print(f"🔒 Блокировка: {LOCK_FILE}")
+        print("🤖 БОТ ЗАПУЩЕН!" if len(apps) == 1 else f"🤖 ЗАПУЩЕНО БОТОВ: {len(apps)}")
+        
+        for app in apps:
+            if not os.path.exists(app.admin_mode_file):
+                set_admin_accepting(app, True)
+            
+            for admin in app.admins:
+                if admin not in app.user_id_map:
+                    get_user_id_counter(app, admin)
+            
+            app.tasks.service("cleanup", partial(cleanup_old_messages, app))
+            app.tasks.service("scheduler", partial(run_scheduler, app))
+            app.tasks.service("reprobe", partial(reprobe_unreachable, app))
+            start_intake_workers(app)
+            
+            print("="*50)
+            print(f"👤 Админы: {app.admins}")
+            print(f"📢 Канал: {app.channel_id}")
+            print(f"👥 Пользователей: {len(app.user_id_map)}")
+            print(f"📁 Данные: {app.data_dir}")
+            print(f"🔒 Блокировка: {app.lock_path}")
+            print(f"⏱ Запуск: {app.startup_time * 1000:.0f} мс")
+        if apps[0].trace_recorder:
+            print("="*50)
+            print(f"🎞 Запись трафика: {apps[0].trace_recorder.directory}")
         print("="*50 + "\n")
         
-        await dp.start_polling(bot)
+        loop_watchdog.start()
         
+        # Все боты опрашиваются одним диспетчером в одном event loop.
+        # Сессия закрывается после остановки задач: им может понадобиться Bot API
+        await apps[0].dp.start_polling(*[app.bot for app in apps], close_bot_session=False)
+    
     except Exception as e:
         logging.error(f"Критическая ошибка: {e}")
     finally:
-        # Освобождаем блокировку при завершении
-        release_lock(lock_file)
+        loop_watchdog.stop()
+        await asyncio.gather(*(app.tasks.shutdown() for app in apps))
+        await apps[0].bot.session.close()
+        # Дописываем отложенные файлы и освобождаем блокировки
+        for app in apps:
+            await asyncio.to_thread(close_app, app)
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) > 1:
+        sys.exit(run_cli(sys.argv[1:]))
+    
+    try:
+        recorder = None
+        if os.environ.get("TRACE_DIR"):
+            recorder = TraceRecorder(os.environ["TRACE_DIR"], os.environ.get("TRACE_KEEP_TEXT") == "1")
+        apps = create_apps(load_configs(), recorder=recorder)
+    except ConfigError as e:
+        print(f"❌ ОШИБКА: {e}")
+        sys.exit(1)
+    except AlreadyRunningError as e:
+        print("❌ ОШИБКА: Бот уже запущен в другом экземпляре!")
+        print("   Если вы уверены, что это ошибка, удалите файл:", e.lock_path)
+        sys.exit(1)
+    
     try:
-        asyncio.run(main())
+        asyncio.run(main(apps))
     except KeyboardInterrupt:
         print("\n🛑 Бот остановлен")
-        release_lock(lock_file)
+        for app in apps:
+            close_app(app)
     except Exception as e:
         print(f"\n❌ Ошибка: {e}")
-        release_lock(lock_file)
+        for app in apps:
+            close_app(app)